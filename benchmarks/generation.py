@@ -0,0 +1,197 @@
+# Generation
+# Throughput and latency benchmarks for the email and text generation hot paths
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import contextlib
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+BASELINE_FILE = os.path.join(REPO, 'benchmarks', 'baselines.json')
+CACHE_DIR = os.path.join(REPO, 'data', '.cache')
+CORPORA = ['cov', 'ga', 'rumor', 'secrecy']
+MIN_TIME = 1.0
+HEADERS = {'subject': 'Benchmark Subject', 'sender': 'sender@test.com', 'recipients': ['recipient@test.com'],
+           'cc_recipients': [], 'bcc_recipients': [], 'language': 'en', 'charset': 'utf-8'}
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+def summarize(latencies, count, total):
+    """
+    Returns messages/sec and p50/p99 per-message latency in milliseconds
+    """
+    return {'msgs_per_sec': count / total if total else 0.0,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000}
+
+def per_call(func, num, min_time=MIN_TIME):
+    """
+    Times every call of func over i in range(num), starting over from 0 until min_time seconds
+    have passed as well, so small scales still time enough calls for stable figures
+    """
+    latencies = []
+    start = time.perf_counter()
+    while len(latencies) < num or time.perf_counter() - start < min_time:
+        call_start = time.perf_counter()
+        func(len(latencies) % num)
+        latencies.append(time.perf_counter() - call_start)
+    return summarize(latencies, len(latencies), time.perf_counter() - start)
+
+def per_run(func, num, repeats, min_time=MIN_TIME):
+    """
+    Times whole runs of func and reports throughput only, a run's time divided by num is an
+    average rather than a per-message latency, so no percentiles are given
+
+    Each of the repeats runs func back to back until min_time seconds have passed, so small runs
+    are not dominated by thread startup and timer noise. Throughput uses the fastest repeat, as
+    timeit does, since slower repeats mostly measure noise
+    """
+    best = None
+    for _ in range(repeats):
+        runs = 0
+        start = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            while True:
+                func()
+                runs += 1
+                elapsed = time.perf_counter() - start
+                if elapsed >= min_time:
+                    break
+        best = elapsed / runs if best is None else min(best, elapsed / runs)
+    return {'msgs_per_sec': num / best if best else 0.0}
+
+def bench_messages(texts, num, attachment, min_time=MIN_TIME):
+    from tools.generateemail import create_message, html, make_reply
+
+    def build(i, attachments=[]):
+        text = texts[i % len(texts)]
+        return create_message(text=text, html=html(text), attachments=attachments, **HEADERS)
+
+    def reply(i):
+        str(make_reply(build(i + 1), build(i)))
+
+    return {
+        'create_message': lambda: per_call(lambda i: str(build(i)), num, min_time),
+        'create_message_attachments': lambda: per_call(lambda i: str(build(i, attachment)), num, min_time),
+        'make_reply': lambda: per_call(reply, num, min_time),
+    }
+
+def bench_runs(corpus, num, repeats, min_time=MIN_TIME):
+    import generateemaildata as email_data
+    import generatetextdata as text_data
+
+    args = (HEADERS['subject'], HEADERS['sender'], HEADERS['recipients'], [], [], corpus, 'en', 'utf-8', num)
+    return {
+        'write_rand_email': lambda: per_run(lambda: email_data.write_rand_email(*args, '', False, seed=1), num, repeats, min_time),
+        'write_thread': lambda: per_run(lambda: email_data.write_thread(*args), num, repeats, min_time),
+        'rand_sample_text': lambda: per_run(lambda: text_data.rand_sample_text(corpus, num, True, '', True, seed=1), num, repeats, min_time),
+    }
+
+def benchmarks(args):
+    """
+    Returns {name: function} of every benchmark, each function measuring it once and returning
+    its result
+    """
+    from tools.corpus import load_corpus
+    import generatetextdata as text_data
+
+    attachment_path = os.path.join(args.workdir, 'attachment.bin')
+    with open(attachment_path, 'wb') as af:
+        af.write(os.urandom(args.attachment_kb * 1024))
+    af.close()
+
+    benches = {}
+    for name in args.corpora:
+        corpus = load_corpus(os.path.join(REPO, 'data', '%s_corpus.csv' % name), CACHE_DIR)
+        texts = corpus[range(min(len(corpus), 1000))]
+
+        benches['original_text/%s/%s' % (name, len(corpus))] = (
+            lambda corpus=corpus: per_run(lambda: text_data.original_text(corpus, True), len(corpus), args.repeats, args.min_time))
+        for num in args.scales:
+            for bench, measure in list(bench_messages(texts, num, attachment_path, args.min_time).items()) + list(bench_runs(corpus, num, args.repeats, args.min_time).items()):
+                benches['%s/%s/%s' % (bench, name, num)] = measure
+    return benches
+
+def regressed(results, baseline, tolerance):
+    return [key for key, result in results.items()
+            if baseline.get(key) and result['msgs_per_sec'] / baseline[key]['msgs_per_sec'] < 1 - tolerance]
+
+def run(args, baseline):
+    """
+    Measures every benchmark, then measures the ones slower than baseline again up to
+    args.retries times, keeping their fastest result, so a regression has to show on every
+    attempt rather than in one slow stretch of a shared machine
+    """
+    benches = benchmarks(args)
+    results = {key: measure() for key, measure in benches.items()}
+    for _ in range(args.retries):
+        retry = regressed(results, baseline, args.tolerance)
+        if not retry:
+            break
+        for key in retry:
+            result = benches[key]()
+            if result['msgs_per_sec'] > results[key]['msgs_per_sec']:
+                results[key] = result
+    return results
+
+def report(results, baseline, tolerance):
+    regressions = []
+    print('%-44s %12s %10s %10s %10s' % ('benchmark', 'msgs/sec', 'p50 ms', 'p99 ms', 'baseline'))
+    for key, result in results.items():
+        base = baseline.get(key)
+        change = ''
+        if base:
+            ratio = result['msgs_per_sec'] / base['msgs_per_sec']
+            change = '%+.0f%%' % ((ratio - 1) * 100)
+            if ratio < 1 - tolerance:
+                regressions.append(key)
+                change += ' REGRESSED'
+        latency = ['%.3f' % result[q] if q in result else '-' for q in ('p50_ms', 'p99_ms')]
+        print('%-44s %12.0f %10s %10s %10s' % (key, result['msgs_per_sec'], latency[0], latency[1], change))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark generation throughput and latency')
+    parser.add_argument('--scales', default='100,1000', help='Comma separated --numdata values to benchmark')
+    parser.add_argument('--corpora', default=','.join(CORPORA), help='Comma separated bundled scenarios to benchmark')
+    parser.add_argument('--repeats', default=3, type=int, help='Repeats for whole-run benchmarks')
+    parser.add_argument('--min_time', default=MIN_TIME, type=float, help='Seconds every benchmark keeps running for, whole-run benchmarks per repeat')
+    parser.add_argument('--attachment_kb', default=100, type=int, help='Size of the attachment used by create_message_attachments')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='Baseline .json file to compare against or save to')
+    parser.add_argument('--tolerance', default=0.25, type=float, help='Allowed fractional drop in msgs/sec before a benchmark counts as regressed')
+    parser.add_argument('--retries', default=2, type=int, help='Times a benchmark below the tolerance is measured again before it counts as regressed')
+    parser.add_argument('--save', default=False, action='store_true', help='Save these results as the new baseline')
+    args = parser.parse_args()
+    args.scales = [int(x) for x in args.scales.split(',')]
+    args.corpora = args.corpora.split(',')
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as bf:
+            baseline = json.load(bf)
+        bf.close()
+    compare = {} if args.save else baseline
+
+    # Generators write relative to the working directory, so every run writes into a scratch directory
+    with tempfile.TemporaryDirectory() as workdir:
+        args.workdir = workdir
+        os.chdir(workdir)
+        results = run(args, compare)
+
+    regressions = report(results, compare, args.tolerance)
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, 'w') as bf:
+            json.dump(baseline, bf, indent=2, sort_keys=True)
+        bf.close()
+        print('\nSaved baseline to', args.baseline)
+
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,112 @@
+# Smtpserver
+# Minimal asyncio SMTP server that accepts and discards mail, used to exercise the smtp sink
+
+import os
+import sys
+import time
+import signal
+import asyncio
+import argparse
+
+class Stats:
+    def __init__(self):
+        self.sessions = 0
+        self.messages = 0
+        self.deferred = 0
+        self.dropped = 0
+        self.start = None
+        self.end = None
+
+    def report(self):
+        elapsed = (self.end - self.start) if self.start is not None and self.end is not None else 0.0
+        print('%d sessions | %d messages | %d deferred | %d dropped | %.1f msgs/sec' % (
+            self.sessions, self.messages, self.deferred, self.dropped, self.messages / elapsed if elapsed else 0.0))
+        sys.stdout.flush()
+
+async def session(reader, writer, args, stats):
+    """
+    Speaks enough ESMTP for the smtp sink: EHLO/HELO advertising PIPELINING unless
+    --no_pipelining is given, MAIL, RCPT, DATA, RSET, NOOP and QUIT. Every --defer_every-th
+    message gets a 451 after DATA and every --drop_every-th transaction has its connection closed,
+    to exercise retries. With --save_dir accepted messages are written there, dot-unstuffed
+    """
+    stats.sessions += 1
+    writer.write(b'220 localhost smtpserver ready\r\n')
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            command = line[:4].upper()
+            if command == b'EHLO':
+                writer.write(b'250-localhost\r\n' + (b'' if args.no_pipelining else b'250-PIPELINING\r\n') + b'250-8BITMIME\r\n250 SIZE 104857600\r\n')
+            elif command == b'HELO':
+                writer.write(b'250 localhost\r\n')
+            elif command == b'MAIL':
+                if args.drop_every and (stats.messages + stats.deferred + stats.dropped + 1) % args.drop_every == 0:
+                    stats.dropped += 1
+                    break
+                writer.write(b'250 OK\r\n')
+            elif command == b'RCPT':
+                writer.write(b'250 OK\r\n')
+            elif command == b'DATA':
+                writer.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+                await writer.drain()
+                lines = []
+                while True:
+                    data = await reader.readline()
+                    if not data or data == b'.\r\n':
+                        break
+                    if args.save_dir:
+                        lines.append(data[1:] if data.startswith(b'.') else data)
+                if stats.start is None:
+                    stats.start = time.perf_counter()
+                if args.defer_every and (stats.messages + stats.deferred + 1) % args.defer_every == 0:
+                    stats.deferred += 1
+                    writer.write(b'451 Try again later\r\n')
+                else:
+                    stats.messages += 1
+                    stats.end = time.perf_counter()
+                    if args.save_dir:
+                        with open(os.path.join(args.save_dir, '%d.eml' % stats.messages), 'wb') as f:
+                            f.write(b''.join(lines))
+                    writer.write(b'250 OK queued\r\n')
+            elif command in (b'RSET', b'NOOP'):
+                writer.write(b'250 OK\r\n')
+            elif command == b'QUIT':
+                writer.write(b'221 Bye\r\n')
+                await writer.drain()
+                break
+            else:
+                writer.write(b'502 Command not implemented\r\n')
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def main(args):
+    stats = Stats()
+    server = await asyncio.start_server(lambda r, w: session(r, w, args, stats), args.host, args.port)
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set_result, None)
+    print('Listening on %s:%s' % (args.host, args.port))
+    sys.stdout.flush()
+    async with server:
+        await stop
+    stats.report()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a local SMTP server that discards every message')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', default=8025, type=int)
+    parser.add_argument('--defer_every', default=0, type=int, help='Answer every Nth message with a 451 temporary failure')
+    parser.add_argument('--drop_every', default=0, type=int, help='Close the connection on every Nth transaction')
+    parser.add_argument('--no_pipelining', default=False, action='store_true', help='Do not advertise PIPELINING, so clients fall back to one command per round trip')
+    parser.add_argument('--save_dir', default='', help='Directory accepted messages are written to, dot-unstuffed, as <n>.eml')
+    args = parser.parse_args()
+    if args.save_dir:
+        os.makedirs(args.save_dir, exist_ok=True)
+    asyncio.run(main(args))
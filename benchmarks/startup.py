@@ -0,0 +1,70 @@
+# Startup
+# Measures CLI startup time against a budget and checks that heavy dependencies stay lazy
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ['pandas', 'numpy', 'nlpaug', 'torch', 'transformers']
+
+# Each case is run from an empty working directory so no output or cache is reused
+CASES = {
+    'email_custom': [os.path.join(REPO, 'generateemaildata.py'), '-c', '--numdata=1'],
+    'email_help': [os.path.join(REPO, 'generateemaildata.py'), '--help'],
+    'text_help': [os.path.join(REPO, 'generatetextdata.py'), '--help'],
+}
+
+def time_case(argv, runs):
+    timings = []
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as cwd:
+            start = time.perf_counter()
+            subprocess.run([sys.executable] + argv, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            timings.append(time.perf_counter() - start)
+    return timings
+
+def heavy_imports(module):
+    """
+    Returns the heavy modules that importing module pulls in, which should be none
+    """
+    code = 'import sys, %s; print(" ".join(m for m in %r if m in sys.modules))' % (module, HEAVY_MODULES)
+    result = subprocess.run([sys.executable, '-c', code], cwd=REPO, capture_output=True, text=True, check=True)
+    return result.stdout.split()
+
+def run(args):
+    failed = False
+    results = {}
+
+    for module in ('generateemaildata', 'generatetextdata'):
+        loaded = heavy_imports(module)
+        if loaded:
+            failed = True
+        print('%-18s heavy imports: %s' % (module, ', '.join(loaded) or 'none'))
+
+    for name, argv in CASES.items():
+        timings = time_case(argv, args.runs)
+        median = statistics.median(timings)
+        results[name] = {'median': median, 'min': min(timings), 'max': max(timings)}
+        over = median > args.budget
+        failed = failed or over
+        print('%-18s median %.3fs  min %.3fs  max %.3fs  %s' % (name, median, min(timings), max(timings), 'OVER BUDGET' if over else 'ok'))
+
+    if args.output:
+        with open(args.output, 'w') as of:
+            json.dump({'budget': args.budget, 'results': results}, of, indent=2)
+        of.close()
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark CLI startup time')
+    parser.add_argument('--runs', default=5, type=int, help='Runs per case, the median is compared to the budget')
+    parser.add_argument('--budget', default=0.5, type=float, help='Maximum median startup time in seconds')
+    parser.add_argument('--output', default='', help='Optional .json file for the results')
+    sys.exit(run(parser.parse_args()))
@@ -3,44 +3,54 @@
 # This tool will generate email test data for product fail-state testing
 
 import os
-import time
 import timeit
 import logging
-import hashlib
-import errno
 import random
 import argparse
-import pandas as pd
-import nlpaug.augmenter.word as naw
-import nlpaug.flow as naf
 
-from tools.generateemail import create_message, html, make_reply
+from tools.generateemail import create_message, html, ReplyChain, attachment_cache
+from tools.fastmime import render_message, validate_message
+from tools.augment import get_engine
+from tools.parallel import chunk_tasks, map_chunks
+from tools.pipeline import WriterPool
+from tools.sinks import SINKS, open_sink
+from tools.compress import COMPRESSIONS, compressor
+from tools.messageid import IdGenerator, id_domain
+from tools.metrics import get_metrics, profile, Progress
 
 emails = os.getcwd() + '/emailoutput/emails/'
 rand_samp_emails = os.getcwd() + '/emailoutput/randsampemails/'
 augmented_emails = os.getcwd() + '/emailoutput/augmentedemails/'
+# Default metrics and manifest files, one per --worker_id so processes sharing a store keep their own
+metrics_file = os.getcwd() + '/emailoutput/metrics-%d.json'
+manifest_file = os.getcwd() + '/emailoutput/manifest-%d.jsonl'
 
-# Make directory to store email outputs
-if not os.path.exists(os.path.dirname(emails)):
-    try:
-        os.makedirs(os.path.dirname(emails))
-    except OSError as exc:
-        if exc.errno != errno.EEXIST:
-            raise
+# ID space for file names and Message-IDs, set from --worker_id
+worker_id = 0
 
-if not os.path.exists(os.path.dirname(augmented_emails)):
-    try:
-        os.makedirs(os.path.dirname(augmented_emails))
-    except OSError as exc:
-        if exc.errno != errno.EEXIST:
-            raise
+# Size in bytes at which threads and mbox files roll over to a new file, set from --rollover_mb
+rollover_bytes = 0
 
-if not os.path.exists(os.path.dirname(rand_samp_emails)):
-    try:
-        os.makedirs(os.path.dirname(rand_samp_emails))
-    except OSError as exc:
-        if exc.errno != errno.EEXIST:
-            raise
+# Compression ('gzip' or 'zstd') and level of the written files, set from --compress and --compress_level
+compression = ''
+compress_level = None
+
+# Number of threads writing finished emails, set from --writers
+writers = 1
+
+# SmtpPool used by the smtp sink, set from --smtp
+smtp_pool = None
+
+# Whether every written email is printed, set from --verbose, otherwise progress is logged every progress_interval seconds
+verbose = False
+progress_interval = 5.0
+
+# Manifest of written emails, set from --manifest, holding what an interrupted run wrote when --resume is given
+checkpoint = None
+
+# Arguments that only change how a run is executed, a resumed run may set them differently
+RUN_OPTIONS = ('workers', 'writers', 'smtp', 'smtp_retries', 'attachment_cache_mb', 'augment_cache_mb',
+               'metrics', 'profile', 'progress_interval', 'verbose', 'manifest', 'resume')
 
 # LOGGING
 LOG_FILE = 'cmdltest.log'
@@ -56,26 +66,210 @@ def scenario_error():
     print('\n', '----------------------------------------------------------------------', '\n')
     print('Available Scenarios:', '\n', '-- secrecy', '\n', '-- ga', '\n', '-- rumor', '\n', '-- cov', '\n')
 
-def create_hash(subject, sender, recipients):
-    hash = hashlib.md5(
-            str(subject)
-            .join(str(sender))
-            .join(str(recipients))
-            .join(str(time.time()))
-            .encode('utf-8')).hexdigest()
+def make_ids(headers, seed, mode):
+    # Every generate() call of a run names its emails from counter 0, the mode keeps their IDs apart
+    return IdGenerator(seed, worker_id, id_domain(headers['sender']), mode)
+
+def build_message(headers, body, attachments=[], message_id=None, in_reply_to=None, references=None, scenario=None):
+    email = create_message(subject=headers['subject'],
+                            sender=headers['sender'],
+                            recipients=headers['recipients'],
+                            cc_recipients=headers['cc_recipients'],
+                            bcc_recipients=headers['bcc_recipients'],
+                            text=body,
+                            html=html(body),
+                            attachments=attachments,
+                            language=headers['language'],
+                            charset=headers['charset'],
+                            message_id=message_id,
+                            in_reply_to=in_reply_to,
+                            references=references,
+                            scenario=scenario,
+                            )
+    return email
+
+def serialize_message(headers, body, attachments=[], message_id=None, in_reply_to=None, references=None, scenario=None):
+    """
+    Returns the serialized email, using the fast template renderer for text + html emails
+    when --fastmime or --validatemime is set
+    """
+    metrics = get_metrics()
+    if headers['mime']:
+        fields = dict(sender=headers['sender'], subject=headers['subject'], text=body, html=html(body),
+                      recipients=headers['recipients'], cc_recipients=headers['cc_recipients'], bcc_recipients=headers['bcc_recipients'],
+                      language=headers['language'], charset=headers['charset'], attachments=attachments, message_id=message_id,
+                      in_reply_to=in_reply_to, references=references, scenario=scenario)
+        with metrics.timer('render'):
+            if headers['mime'] == 'validate':
+                return validate_message(**fields)
+            return render_message(**fields)
+    with metrics.timer('build'):
+        email = build_message(headers, body, attachments, message_id, in_reply_to, references, scenario)
+    with metrics.timer('serialize'):
+        return str(email)
+
+_worker = {}
+
+def init_worker(mode, texts, labels, headers, seed, ids):
+    """
+    Loads the corpus texts and run settings once per process
+    """
+    _worker.update(mode=mode, texts=texts, labels=labels, headers=headers, seed=seed, ids=ids)
+
+def entry(message_id, labels, row):
+    # Manifest entry of an email, rows are the sampled corpus row, or the rows of a reply chain
+    if labels is None:
+        return message_id, None, None
+    if isinstance(row, (list, tuple)):
+        return message_id, [int(i) for i in row], [int(labels[i]) for i in row]
+    return message_id, int(row), int(labels[row])
+
+def build_chunk(task):
+    """
+    Builds and serializes one chunk of emails
 
-    return hash
+    Runs in the current process for serial runs and inside a pool worker when --workers is above 1,
+    a chunk always produces the same records given the same seed
 
-def rand_state(input_file):
-    return random.randint(0, len(input_file)-1)
+    Parameters:
+    -----------
+    task : tuple
+        (offset, indices) where offset is the position of the chunk within the run and
+        indices are the sampled corpus rows, or one row per reply chain for replies
+
+    Returns:
+    --------
+    List of (directory, name, text, action, entry) records in output order, entry being the
+    (Message-ID, row, label) recorded in the manifest, and the stage metrics and augmentation
+    stats gathered while building them
+    """
+    offset, indices = task
+    mode = _worker['mode']
+    texts = _worker['texts']
+    labels = _worker['labels']
+    headers = _worker['headers']
+    seed = _worker['seed']
+    ids = _worker['ids']
+    metrics = get_metrics()
+    metrics.count('chunks')
+    records = []
+
+    if seed is not None:
+        # MIME boundaries and augmentation draw from the global random module
+        random.seed('%s:%s' % (seed, offset))
+
+    if mode == 'reply':
+        # Each row of indices is one chain, oldest email first, and only its last email is written
+        for i, rows in enumerate(indices):
+            name = ids.name(offset + i)
+            message_id = ids.message_id(name)
+            with metrics.timer('build'):
+                chain = ReplyChain()
+                for j in rows[:-1]:
+                    chain.add(build_message(headers, texts[j]))
+                chain.add(build_message(headers, texts[rows[-1]], message_id=message_id))
+                email = chain.message()
+            with metrics.timer('serialize'):
+                records.append((rand_samp_emails, name, str(email), 'CREATED', entry(message_id, labels, list(rows))))
+        metrics.count('emails_created', len(indices))
+        return records, {'metrics': metrics.take()}
+
+    bodies = [texts[i] for i in indices]
+
+    if mode == 'thread':
+        # Each email replies to the one before it, so readers can rebuild the thread from its headers
+        for i, (row, body) in enumerate(zip(indices, bodies)):
+            message_id = ids.message_id(ids.name(offset + i))
+            in_reply_to, references = ids.thread_headers(offset + i)
+            records.append((rand_samp_emails, headers['thread_name'], serialize_message(headers, body, [], message_id, in_reply_to, references), None, entry(message_id, labels, row)))
+        metrics.count('emails_created', len(bodies))
+        return records, {'metrics': metrics.take()}
+
+    directory = emails if mode == 'custom' else rand_samp_emails
+    names = [ids.name(offset + i) for i in range(len(bodies))]
+    # Multi-scenario runs record each email's scenario in an X-Scenario header
+    scenarios = texts.scenarios(indices) if getattr(texts, 'mixed', False) else [None] * len(bodies)
+    for name, row, body, scenario in zip(names, indices, bodies, scenarios):
+        message_id = ids.message_id(name)
+        records.append((directory, name, serialize_message(headers, body, headers['attachments'], message_id, scenario=scenario), 'CREATED', entry(message_id, labels, row)))
+    metrics.count('emails_created', len(bodies))
+
+    if headers['augment']:
+        # Banked variants are drawn from the chunk's seeded random state, anything else goes through the augmenter
+        bank = headers['bank']
+        with metrics.timer('augment'):
+            aug_texts = bank.sample(indices) if bank is not None else get_engine().augment(bodies, seed, offset)
+        # Augmented copies keep the original's file name in their own folder but get their own Message-ID
+        for name, row, aug_text, scenario in zip(names, indices, aug_texts, scenarios):
+            message_id = ids.message_id(name + '.aug')
+            records.append((augmented_emails, name, serialize_message(headers, aug_text, headers['attachments'], message_id, scenario=scenario), 'AUGMENTED', entry(message_id, labels, row)))
+        metrics.count('emails_augmented', len(bodies))
+        if bank is None:
+            return records, {'metrics': metrics.take(), 'augment': get_engine().take_stats()}
+    return records, {'metrics': metrics.take()}
+
+def output_keys(mode, headers, ids, task):
+    # The (directory, name) of every record build_chunk writes for a task
+    offset, indices = task
+    names = [ids.name(offset + i) for i in range(len(indices))]
+    keys = [(emails if mode == 'custom' else rand_samp_emails, name) for name in names]
+    if headers['augment'] and mode in ('rand', 'custom'):
+        keys += [(augmented_emails, name) for name in names]
+    return keys
+
+def generate(mode, texts, indices, headers, seed, workers, sink='eml', file_mode='w', ids=None, labels=None):
+    """
+    Runs generation as a pipeline: the sampled indices are split into chunks, each chunk is
+    built, augmented and serialized inline or across the worker pool, and finished records are
+    handed through bounded queues to writer threads that write them to one sink per output
+    directory, so disk writes overlap with building the next chunks
 
-def augmenter():
-    return naf.Sometimes([
-            naw.SpellingAug(aug_max=1),
-            naw.ContextualWordEmbsAug(model_path='roberta-base', action='substitute', aug_max=1)],
-            aug_p=0.8)
+    Emails are named by their position in the run through ids, a fresh IdGenerator when not given.
+    Written emails are recorded in the manifest along with their row and label from labels
 
-def write_email(subject, sender, recipients, cc_recipients, bcc_recipients, body, attachments, language, charset, num, augment):
+    When resuming, chunks the interrupted run wrote completely are skipped and partly written
+    chunks are rebuilt from their seed with only their missing emails written, so the output
+    matches an uninterrupted run
+    """
+    ids = make_ids(headers, seed, mode) if ids is None else ids
+    # Augmented chunks line up with the augmenter's aligned batches, so seeded output does not depend on the chunking
+    tasks = chunk_tasks(indices, get_engine().batch_size) if headers['augment'] else chunk_tasks(indices)
+    resume = checkpoint is not None and bool(checkpoint.done)
+    ordered = file_mode == 'a' or sink in ('mbox', 'tar')
+    if sink == 'smtp':
+        from tools.smtp import SmtpSink, envelope
+        mail_from, rcpt_to = envelope(headers['sender'], headers['recipients'], headers['cc_recipients'], headers['bcc_recipients'])
+        open_output = lambda directory: SmtpSink(smtp_pool, mail_from, rcpt_to)
+    else:
+        open_output = lambda directory: open_sink(sink, directory, rollover_bytes, compression, compress_level)
+    # Augmented runs write an augmented copy next to every email
+    total = len(indices) * (2 if headers['augment'] and mode in ('rand', 'custom') else 1)
+    if resume:
+        missing = [(task, sum(not checkpoint.written(*key) for key in output_keys(mode, headers, ids, task))) for task in tasks]
+        tasks = [task for task, count in missing if count]
+        remaining = sum(count for _, count in missing)
+        logger.info('Resuming: %d of %d emails already written', total - remaining, total)
+        total = remaining
+    progress = Progress(total, 'emails', progress_interval)
+    writer = WriterPool(open_output, writers, ordered, file_mode == 'a', progress=progress, verbose=verbose, manifest=checkpoint)
+    try:
+        for records, stats in map_chunks(build_chunk, tasks, workers, init_worker, (mode, texts, labels, headers, seed, ids)):
+            get_metrics().merge(stats['metrics'])
+            if 'augment' in stats:
+                get_engine().merge_stats(stats['augment'])
+            if resume:
+                records = [record for record in records if not checkpoint.written(record[0], record[1])]
+            writer.put(records)
+    finally:
+        writer.close()
+    progress.close()
+
+def make_headers(subject, sender, recipients, cc_recipients, bcc_recipients, attachments, language, charset, augment=False, mime='', bank=None):
+    return {'subject': subject, 'sender': sender, 'recipients': recipients, 'cc_recipients': cc_recipients,
+            'bcc_recipients': bcc_recipients, 'attachments': attachments, 'language': language, 'charset': charset,
+            'augment': augment, 'mime': mime, 'bank': bank}
+
+def write_email(subject, sender, recipients, cc_recipients, bcc_recipients, body, attachments, language, charset, num, augment, seed=None, workers=1, sink='eml', mime=''):
     """
     Creates an email based off the given parameters
 
@@ -124,51 +318,31 @@ def write_email(subject, sender, recipients, cc_recipients, bcc_recipients, body
     augment : Boolean
         A Boolean value to determine if the body will be augmented
         Default : False
+
+    seed : int
+        Seed for the random number generator, seeded runs sample the same rows and file names for any number of workers
+        Default : None
+
+    workers : int
+        Number of worker processes used to build and serialize emails
+        Default : 1
+
+    sink : str
+        Output container for the emails, one of 'eml', 'mbox', 'maildir', 'tar' or 'smtp'
+        Default : 'eml'
+
+    mime : str
+        'fast' renders text + html emails through the template serializer,
+        'validate' also checks each one parses the same as create_message
+        Default : ''
     """
+    headers = make_headers(subject, sender, recipients, cc_recipients, bcc_recipients, attachments, language, charset, augment, mime)
+
     print('\n')
-    for _ in range(int(num)):
-        hash = create_hash(subject, sender, recipients)
-
-        with open(emails+hash+'.eml', 'w') as ef:
-            email = create_message(subject=subject,
-                                    sender=sender,
-                                    recipients=recipients,
-                                    cc_recipients=cc_recipients,
-                                    bcc_recipients=bcc_recipients,
-                                    text=body,
-                                    html=html(body),
-                                    attachments=attachments,
-                                    language=language,
-                                    charset=charset,
-                                    )
-            ef.write(str(email))
-            ef.write('\n')
-        ef.close()
-        print('#####    CREATED:', hash + '.eml  #####')
-
-        if augment:
-            aug = augmenter()
-            aug_text = aug.augment(body)
-
-            with open(augmented_emails+hash+'.eml', 'w') as af:
-                email = create_message(subject=subject,
-                                    sender=sender,
-                                    recipients=recipients,
-                                    cc_recipients=cc_recipients,
-                                    bcc_recipients=bcc_recipients,
-                                    text=aug_text,
-                                    html=html(aug_text),
-                                    attachments=attachments,
-                                    language=language,
-                                    charset=charset,
-                                    )
-                af.write(str(email))
-                af.write('\n')
-            af.close()
-            print('#####    AUGMENTED:', hash + '.eml   #####')
+    generate('custom', [body], [0] * int(num), headers, seed, workers, sink)
     print('\n')
 
-def write_rand_email(subject, sender, recipients, cc_recipients, bcc_recipients, data_file, language, charset, num, label_case, augment):
+def write_rand_email(subject, sender, recipients, cc_recipients, bcc_recipients, data_file, language, charset, num, label_case, augment, seed=None, workers=1, sink='eml', sampler=None, mime='', bank=None, label_ratio=None):
     """
     skipping out on attachments for now for ease of use
 
@@ -196,8 +370,9 @@ def write_rand_email(subject, sender, recipients, cc_recipients, bcc_recipients,
     bcc_recipients : List
         A given list of strings to define the bcc_recipients of the email
 
-    data_file : DataFrame
-        A Pandas DataFrame from a given input file
+    data_file : DataFrame or Corpus
+        A Pandas DataFrame from a given input file, a compiled scenario Corpus, or a CorpusMix
+        of several scenarios sampled by their weights
 
     language : str
         A given string to specify the language in the header
@@ -217,68 +392,53 @@ def write_rand_email(subject, sender, recipients, cc_recipients, bcc_recipients,
     augment : Boolean
         A Boolean value to determine if the body will be augmented
         Default : False
-    """
-    text_column = data_file.columns.get_loc("text")
-    #label_column = data_file.columns.get_loc("label") // Not needed for now
 
-    pos_case = data_file[data_file.label == 1]
-    neg_case = data_file[data_file.label == 0]
+    seed : int
+        Seed for the random number generator, seeded runs sample the same rows and file names for any number of workers
+        Default : None
+
+    workers : int
+        Number of worker processes used to build and serialize emails
+        Default : 1
+
+    sink : str
+        Output container for the emails, one of 'eml', 'mbox', 'maildir', 'tar' or 'smtp'
+        Default : 'eml'
+
+    sampler : BatchSampler
+        A sampler to draw rows from instead of data_file, such as a ReservoirSampler for --stream
+        Default : None
+
+    mime : str
+        'fast' renders text + html emails through the template serializer,
+        'validate' also checks each one parses the same as create_message
+        Default : ''
+
+    bank : AugmentBank
+        Precomputed variants of data_file's rows that augmented emails are drawn from instead of the augmenter
+        Default : None
+
+    label_ratio : float
+        Fraction of emails with a positive body, exact at any num, None samples by label_case
+        Default : None
+    """
+    if sampler is None:
+        from tools.sampler import make_sampler
+        sampler = make_sampler(data_file, label_case, seed, label_ratio)
+    with get_metrics().timer('sample'):
+        indices = sampler.sample(num)
+    headers = make_headers(subject, sender, recipients, cc_recipients, bcc_recipients, [], language, charset, augment, mime, bank)
 
     print('\n')
-    for _ in range(int(num)):
-        hash = create_hash(subject, sender, recipients)
-
-        if label_case == '1':
-            rand_num = rand_state(pos_case)
-            body = pos_case.iloc[rand_num, text_column]
-        elif label_case == '0':
-            rand_num = rand_state(neg_case)
-            body = neg_case.iloc[rand_num, text_column]
-        else:
-            rand_num = rand_state(data_file)
-            body = data_file.iloc[rand_num, text_column]
-
-        with open(rand_samp_emails+hash+'.eml', 'w') as rf:
-            email = create_message(subject=subject,
-                                    sender=sender,
-                                    recipients=recipients,
-                                    cc_recipients=cc_recipients,
-                                    bcc_recipients=bcc_recipients,
-                                    text=body,
-                                    html=html(body),
-                                    language=language,
-                                    charset=charset,
-                                    )
-            rf.write(str(email))
-            rf.write('\n')
-        rf.close()
-        print('#####    CREATED:', hash + '.eml    #####')
-
-        if augment:
-            aug = augmenter()
-            aug_text = aug.augment(body)
-
-            with open(augmented_emails+hash+'.eml', 'w') as af:
-                email = create_message(subject=subject,
-                                    sender=sender,
-                                    recipients=recipients,
-                                    cc_recipients=cc_recipients,
-                                    bcc_recipients=bcc_recipients,
-                                    text=aug_text,
-                                    html=html(aug_text),
-                                    language=language,
-                                    charset=charset,
-                                    )
-                af.write(str(email))
-                af.write('\n')
-            af.close()
-            print('#####    AUGMENTED:', hash + '.eml   #####')
+    generate('rand', sampler.texts, indices, headers, seed, workers, sink, labels=sampler.labels)
     print('\n')
 
-def write_reply(subject, sender, recipients, cc_recipients, bcc_recipients, data_file, language, charset, num):
+def write_reply(subject, sender, recipients, cc_recipients, bcc_recipients, data_file, language, charset, num, seed=None, workers=1, sink='eml', depth=2):
     """
     Creates an email reply based off the given parameters
 
+    Each .eml is the last email of a chain of depth emails, quoting every earlier email newest first
+
     An inputfile must be given in order for this function to run
 
     Parameters:
@@ -301,8 +461,8 @@ def write_reply(subject, sender, recipients, cc_recipients, bcc_recipients, data
     bcc_recipients : List
         A given list of strings to define the bcc_recipients of the email
 
-    data_file : DataFrame
-        A Pandas DataFrame from a given input file
+    data_file : Corpus or DataFrame
+        The Corpus read from a given input file, or a Pandas DataFrame with a "text" and "label" column
 
     language : str
         A given string to specify the language in the header
@@ -315,35 +475,44 @@ def write_reply(subject, sender, recipients, cc_recipients, bcc_recipients, data
     num : int
         A given integer to create an N number of .eml files
         Default : 1
+
+    seed : int
+        Seed for the random number generator, seeded runs sample the same rows and file names for any number of workers
+        Default : None
+
+    workers : int
+        Number of worker processes used to build and serialize emails
+        Default : 1
+
+    sink : str
+        Output container for the emails, one of 'eml', 'mbox', 'maildir', 'tar' or 'smtp'
+        Default : 'eml'
+
+    depth : int
+        Number of emails in each reply chain, at least 2
+        Default : 2
     """
-    text_column = data_file.columns.get_loc("text")
-    #label_column = data_file.columns.get_loc("label")
+    depth = int(depth)
+    if depth < 2:
+        raise Exception('Reply chains need a depth of at least 2')
+
+    from tools.sampler import BatchSampler
+    sampler = BatchSampler(data_file, seed=seed)
+    with get_metrics().timer('sample'):
+        indices = sampler.sample(depth * int(num)).reshape(-1, depth)
+    headers = make_headers(subject, sender, recipients, cc_recipients, bcc_recipients, [], language, charset)
 
     print('\n')
-    for _ in range(int(num)):
-        hash = create_hash(subject, sender, recipients)
-
-        rand_num = rand_state(data_file)
-        body = data_file.iloc[rand_num, text_column]
-        email1 = create_message(subject=subject, sender=sender, recipients=recipients, cc_recipients=cc_recipients,
-                                bcc_recipients=bcc_recipients, text=body, html=html(body), language=language, charset=charset)
-    
-        rand_num = rand_state(data_file)
-        body = data_file.iloc[rand_num, text_column]
-        email2 = create_message(subject=subject, sender=sender, recipients=recipients, cc_recipients=cc_recipients,
-                                bcc_recipients=bcc_recipients, text=body, html=html(body), language=language, charset=charset)
-
-        with open(rand_samp_emails + hash + '.eml', 'w') as rf:
-            rf.write(str(make_reply(email2, email1)))
-            rf.write('\n')
-        rf.close()
-        print('#####    CREATED:', hash + '.eml reply    #####')
+    generate('reply', sampler.texts, indices, headers, seed, workers, sink, labels=sampler.labels)
     print('\n')
 
-def write_thread(subject, sender, recipients, cc_recipients, bcc_recipients, data_file, language, charset, num):
+def write_thread(subject, sender, recipients, cc_recipients, bcc_recipients, data_file, language, charset, num, seed=None, workers=1, sink='eml', mime=''):
     """
     Creates an email thread based off the given parameters
 
+    The thread streams into one file through a single handle, each email carrying In-Reply-To and
+    References headers for the one before it, and rolls over to numbered files past --rollover_mb
+
     An inputfile must be given in order for this function to run
 
     Parameters:
@@ -366,8 +535,8 @@ def write_thread(subject, sender, recipients, cc_recipients, bcc_recipients, dat
     bcc_recipients : List
         A given list of strings to define the bcc_recipients of the email
 
-    data_file : DataFrame
-        A Pandas DataFrame from a given input file
+    data_file : Corpus or DataFrame
+        The Corpus read from a given input file, or a Pandas DataFrame with a "text" and "label" column
 
     language : str
         A given string to specify the language in the header
@@ -380,37 +549,68 @@ def write_thread(subject, sender, recipients, cc_recipients, bcc_recipients, dat
     num : int
         A given integer to create an N number of .eml files
         Default : 1
-    """
-    text_column = data_file.columns.get_loc("text")
-    #label_column = data_file.columns.get_loc("label")
 
-    hash = create_hash(subject, sender, recipients)
+    seed : int
+        Seed for the random number generator, seeded runs sample the same rows and file names for any number of workers
+        Default : None
+
+    workers : int
+        Number of worker processes used to build and serialize emails
+        Default : 1
+
+    sink : str
+        Output container for the emails, one of 'eml', 'mbox', 'maildir', 'tar' or 'smtp'
+        Default : 'eml'
+
+    mime : str
+        'fast' renders text + html emails through the template serializer,
+        'validate' also checks each one parses the same as create_message
+        Default : ''
+    """
+    from tools.sampler import BatchSampler
+    sampler = BatchSampler(data_file, seed=seed)
+    with get_metrics().timer('sample'):
+        indices = sampler.sample(num)
+    headers = make_headers(subject, sender, recipients, cc_recipients, bcc_recipients, [], language, charset, mime=mime)
+    # The thread file is named after its first email
+    ids = make_ids(headers, seed, 'thread')
+    headers['thread_name'] = ids.name(0)
 
     print('\n')
-    for _ in range(int(num)):
-        rand_num = rand_state(data_file)
-        body = data_file.iloc[rand_num, text_column]
-
-        with open(rand_samp_emails + hash + '.eml', 'a') as tf:
-            email = create_message(subject=subject,
-                                    sender=sender,
-                                    recipients=recipients,
-                                    cc_recipients=cc_recipients,
-                                    bcc_recipients=bcc_recipients,
-                                    text=body,
-                                    html=html(body),
-                                    language=language,
-                                    charset=charset,
-                                    )
-            tf.write(str(email))
-            tf.write('\n')
-        tf.close()
-    print('#####    CREATED:', hash + '.eml thread    #####')
+    generate('thread', sampler.texts, indices, headers, seed, workers, sink, file_mode='a', ids=ids, labels=sampler.labels)
+    print('#####    CREATED:', headers['thread_name'] + '.eml thread    #####')
     print('\n')
 
+def open_checkpoint(args):
+    """
+    Starts the manifest given by --manifest, or with --resume reopens the interrupted run's
+    manifest, whose seed is used when --seed is not given so the same rows are sampled again
+    """
+    from tools.manifest import Manifest, read_settings
+
+    if args.resume:
+        if not args.manifest:
+            raise Exception('--resume needs the --manifest of the interrupted run')
+        if args.thread or args.sink in ('mbox', 'tar'):
+            raise Exception('--resume needs a file or delivery per email, threads and the mbox and tar sinks cannot be resumed')
+        if args.seed is None:
+            args.seed = read_settings(args.manifest).get('seed')
+        if args.seed is None:
+            raise Exception('Only seeded runs can be resumed, start long runs with --seed')
+    settings = {key: value for key, value in vars(args).items() if key not in RUN_OPTIONS}
+    return Manifest(args.manifest, settings, args.resume)
+
 def run(args):
+    global checkpoint
+    if args.metrics is None:
+        args.metrics = metrics_file % args.worker_id
+    if args.manifest is None:
+        args.manifest = manifest_file % args.worker_id
+    if args.manifest or args.resume:
+        checkpoint = open_checkpoint(args)
     print(args)
     logger.debug('Arguments: %s' % args)
+    metrics = get_metrics()
 
     recipients = []
     cc_recipients = []
@@ -446,38 +646,92 @@ def run(args):
     inputfile = args.inputfile
     label_case = args.labelcase
     custom = args.custom
-    
+    seed = args.seed
+    workers = args.workers
+    sink = args.sink
+    stream = args.stream
+    mime = 'validate' if args.validatemime else 'fast' if args.fastmime else ''
+    attachment_cache().max_bytes = args.attachment_cache_mb << 20
+    get_engine().cache.max_bytes = args.augment_cache_mb << 20
+
+    global worker_id, rollover_bytes, writers, smtp_pool, verbose, progress_interval, compression, compress_level
+    worker_id = args.worker_id
+    compression = args.compress
+    compress_level = args.compress_level
+    if compression:
+        if sink == 'smtp':
+            raise Exception('--compress applies to written files and cannot be combined with the smtp sink')
+        # Fails before anything is generated when the level is invalid or zstandard is missing
+        compressor(compression, compress_level)
+    verbose = args.verbose
+    progress_interval = args.progress_interval
+    label_ratio = args.labelratio
+    if label_ratio is not None and label_case:
+        raise Exception('--labelratio and --labelcase cannot be combined')
+    use_bank = args.bank and augment
+    if use_bank and stream:
+        raise Exception('--bank draws variants by corpus row and cannot be combined with --stream')
+    writers = args.writers
+    if sink == 'smtp':
+        # Each writer thread delivers over its own persistent session
+        from tools.smtp import SmtpPool, parse_endpoint
+        smtp_pool = SmtpPool(*parse_endpoint(args.smtp), sessions=writers, retries=args.smtp_retries)
+    rollover_bytes = int(args.rollover_mb * (1 << 20))
+
+    if inputfile or scenario:
+        # pandas and numpy are only needed once a corpus is involved, -c --custom runs skip them,
+        # --inputfile is read into a compact Corpus rather than a DataFrame of str objects
+        from tools.corpus import SCENARIOS, parse_mix, load_mix, scenario_path, read_corpus
+        from tools.sampler import ReservoirSampler
+        from tools.bank import bank_for
+
     if custom:
-        write_email(subject, sender, recipients, cc_recipients, bcc_recipients, body, attachments, language, charset, num, augment)
+        write_email(subject, sender, recipients, cc_recipients, bcc_recipients, body, attachments, language, charset, num, augment, seed, workers, sink, mime=mime)
 
     if inputfile and not (thread or reply):
-        data_file = pd.read_csv(inputfile)
-        write_rand_email(subject, sender, recipients, cc_recipients, bcc_recipients, data_file, language, charset, num, label_case, augment)
+        if stream:
+            with metrics.timer('load'):
+                sampler = ReservoirSampler(inputfile, num, label_case, seed, label_ratio=label_ratio)
+            write_rand_email(subject, sender, recipients, cc_recipients, bcc_recipients, None, language, charset, num, label_case, augment, seed, workers, sink, sampler, mime)
+        else:
+            with metrics.timer('load'):
+                data_file = read_corpus(inputfile)
+            write_rand_email(subject, sender, recipients, cc_recipients, bcc_recipients, data_file, language, charset, num, label_case, augment, seed, workers, sink, mime=mime, bank=bank_for(inputfile) if use_bank else None, label_ratio=label_ratio)
 
     if reply:
-        data_file = pd.read_csv(inputfile)
-        write_reply(subject, sender, recipients, cc_recipients, bcc_recipients, data_file, language, charset, num)
+        with metrics.timer('load'):
+            data_file = read_corpus(inputfile)
+        write_reply(subject, sender, recipients, cc_recipients, bcc_recipients, data_file, language, charset, num, seed, workers, sink, reply)
 
     if thread:
-        data_file = pd.read_csv(inputfile)
-        write_thread(subject, sender, recipients, cc_recipients, bcc_recipients, data_file, language, charset, num)
+        with metrics.timer('load'):
+            data_file = read_corpus(inputfile)
+        write_thread(subject, sender, recipients, cc_recipients, bcc_recipients, data_file, language, charset, num, seed, workers, sink, mime)
 
     if scenario and not inputfile:
-        if scenario == 'cov':
-            data_file = pd.read_csv('data/cov_corpus.csv')
-            write_rand_email(subject, sender, recipients, cc_recipients, bcc_recipients, data_file, language, charset, num, label_case, augment)
-        elif scenario == 'ga':
-            data_file = pd.read_csv('data/ga_corpus.csv')
-            write_rand_email(subject, sender, recipients, cc_recipients, bcc_recipients, data_file, language, charset, num, label_case, augment)
-        elif scenario == 'rumor':
-            data_file = pd.read_csv('data/rumor_corpus.csv')
-            write_rand_email(subject, sender, recipients, cc_recipients, bcc_recipients, data_file, language, charset, num, label_case, augment)
-        elif scenario == 'secrecy':
-            data_file = pd.read_csv('data/secrecy_corpus.csv')
-            write_rand_email(subject, sender, recipients, cc_recipients, bcc_recipients, data_file, language, charset, num, label_case, augment)
+        # --scenario takes one scenario or a weighted mix such as ga:0.6,cov:0.2,rumor:0.1,secrecy:0.1,
+        # each corpus is loaded once and the mix goes through one sampler and one output pipeline
+        names, _ = parse_mix(scenario)
+        if set(names) <= set(SCENARIOS):
+            with metrics.timer('load'):
+                mix = load_mix(scenario)
+                data_file = mix if mix.mixed else mix.corpora[0]
+                bank = bank_for(mix if mix.mixed else scenario_path(names[0])) if use_bank else None
+            write_rand_email(subject, sender, recipients, cc_recipients, bcc_recipients, data_file, language, charset, num, label_case, augment, seed, workers, sink, mime=mime, bank=bank, label_ratio=label_ratio)
         else:
             scenario_error()
 
+    if augment:
+        get_engine().report()
+    if smtp_pool is not None:
+        smtp_pool.close()
+        smtp_pool.report()
+    if checkpoint is not None:
+        checkpoint.close()
+        print('#####    CREATED:', args.manifest, '  #####')
+    if args.metrics:
+        metrics.write(args.metrics, program='generateemaildata', args=vars(args))
+
 if __name__ == '__main__':
     start = timeit.default_timer()
 
@@ -493,17 +747,43 @@ if __name__ == '__main__':
     parser.add_argument('--lang', default='en')
     parser.add_argument('--charset', default='utf-8')
 
-    parser.add_argument('--scenario', default='')
+    parser.add_argument('--scenario', default='', help='Scenario corpus, or a weighted mix such as ga:0.6,cov:0.2,rumor:0.1,secrecy:0.1')
     parser.add_argument('--numdata', default=1, help='Defines a set number of emails to generate, or number of emails in a thread')
     parser.add_argument('--inputfile', default='', help='Input .csv/.txt file for email body')
     parser.add_argument('--labelcase', default='', help='Option to output only positive or negative text')
+    parser.add_argument('--labelratio', default=None, type=float, help='Exact fraction of emails with a positive body, e.g. 0.05')
+    parser.add_argument('--seed', default=None, type=int, help='Seed for reproducible sampling and file names')
+    parser.add_argument('--workers', default=1, type=int, help='Number of worker processes used to build emails')
+    parser.add_argument('--writers', default=1, type=int, help='Number of threads writing finished emails while the next ones are built')
+    parser.add_argument('--worker_id', default=0, type=int, help='ID space (0-65535) for file names and Message-IDs, give each process or host of a shared seeded run its own')
+    parser.add_argument('--sink', default='eml', choices=SINKS + ('smtp',), help='Output container: one .eml per email, mbox, sharded Maildir, tar, or delivery over SMTP')
+    parser.add_argument('--smtp', default='localhost:25', help='host:port the smtp sink delivers to, --writers sets the number of concurrent sessions')
+    parser.add_argument('--smtp_retries', default=3, type=int, help='Retries per email after a dropped SMTP connection or 4xx reply')
+    parser.add_argument('--compress', default='', choices=('',) + COMPRESSIONS, help='Compress the output files as they are written, on a background thread for mbox, tar and thread files')
+    parser.add_argument('--compress_level', default=None, type=int, help='Compression level, 1-9 for gzip (default 6) and 1-22 for zstd (default 3)')
+    parser.add_argument('--stream', default=False, action='store_true', help='Reservoir-sample --inputfile in chunks instead of loading it whole')
+    parser.add_argument('--rollover_mb', default=0, type=float, help='Roll threads and mbox files over to a new numbered file at this size, 0 never rolls over')
+    parser.add_argument('--fastmime', default=False, action='store_true', help='Render text + html emails through the fast template serializer')
+    parser.add_argument('--validatemime', default=False, action='store_true', help='Use the fast serializer and check every email parses the same as the standard one')
+    parser.add_argument('--attachment_cache_mb', default=256, type=int, help='Memory budget in MB for cached base64 encoded attachments')
+    parser.add_argument('--augment_cache_mb', default=256, type=int, help='Size of the on-disk cache of seeded augmentations, 0 disables it')
+    parser.add_argument('--bank', default=False, action='store_true', help='With -a, draw augmented bodies from the bank built by python -m tools.bank instead of running the augmenter')
+    parser.add_argument('--metrics', default=None, help='JSON file receiving per-stage timings and counters at the end of the run, empty to skip it (default emailoutput/metrics-<worker_id>.json)')
+    parser.add_argument('--profile', default='', nargs='?', const='emailoutput/profile.pstats', help='Run under cProfile and dump the stats to this file (default emailoutput/profile.pstats)')
+    parser.add_argument('--manifest', default=None, help='JSON lines file recording every written email with its row and label, used by --resume, empty to skip it (default emailoutput/manifest-<worker_id>.jsonl)')
+    parser.add_argument('--resume', default=False, action='store_true', help='Continue the seeded run recorded in --manifest, skipping the emails it already wrote')
+    parser.add_argument('--progress_interval', default=5.0, type=float, help='Seconds between progress lines with the email count, rate and ETA, 0 only logs the final count')
+    parser.add_argument('-v', '--verbose', default=False, action='store_true', help='Print a line for every email written')
     parser.add_argument('-a', '--augment', default=False, action='store_true', help='Enables email body augmentation')
     parser.add_argument('-c', '--custom', default=False, action='store_true', help='Enables custom CLI-based email creation')
-    parser.add_argument('-r', '--reply', default=False, action='store_true', help='Enables email reply generation')
+    parser.add_argument('-r', '--reply', default=0, nargs='?', const=2, type=int, help='Enables email reply generation, optionally with the number of emails per chain (default 2)')
     parser.add_argument('-t', '--thread', default=False, action='store_true', help='Enables email thread generation')
 
     args = parser.parse_args()
-    run(args)
+    if args.profile:
+        profile(run, args, args.profile)
+    else:
+        run(args)
     logger.info('End.')
 
     stop = timeit.default_timer()
@@ -3,24 +3,25 @@
 # This tool will generate test data for product fail-state testing
 
 import os
-import random
 import timeit
 import logging
 import errno
+import csv
+import random
 import argparse
-import pandas as pd
-import nlpaug.augmenter.word as naw
-import nlpaug.flow as naf
 
-textoutputdir = os.getcwd() + '/textoutput/'
+from tools.augment import get_engine
+from tools.metrics import get_metrics, profile
+from tools.compress import COMPRESSIONS, compressor, open_output, suffix
 
-# Make directory to store original and augmented text outputs
-if not os.path.exists(os.path.dirname(textoutputdir)):
-    try:
-        os.makedirs(os.path.dirname(textoutputdir))
-    except OSError as exc:
-        if exc.errno != errno.EEXIST:
-            raise
+textoutputdir = os.getcwd() + '/textoutput/'
+# Whether every written file is announced, set from --verbose
+verbose = False
+metrics_file = textoutputdir + 'metrics.json'
+WRITE_BUFFER = 1 << 20
+# Compression ('gzip' or 'zstd') and level of the written .csv files, set from --compress and --compress_level
+compression = ''
+compress_level = None
 
 # LOGGING
 LOG_FILE = 'cmdltest.log'
@@ -31,44 +32,58 @@ logger = logging.getLogger('logger')
 logger.setLevel(LOGGING_LEVEL)
 
 def path_creation(pathname):
-    if os.path.exists(textoutputdir+pathname):
+    # The output directory is created on first write rather than at import
+    if not os.path.exists(os.path.dirname(textoutputdir)):
+        try:
+            os.makedirs(os.path.dirname(textoutputdir))
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+    if not verbose:
+        logger.debug('Writing %s', textoutputdir+pathname)
+    elif os.path.exists(textoutputdir+pathname):
         print('#####    UPDATED:', pathname, '  #####')
     else:
         print('#####    CREATED:', pathname, '  #####')
 
-def rand_state(data_file):
-    return random.randint(0, len(data_file)-1)
-
 def original_text(data_file, labeled):
     """ 
     Writes the original text data given by parameter into a seperate .csv file 
 
     .csv file should have a "text" and "label" column
 
+    Rows are written in chunks with standard .csv quoting
+
     Parameter:
     ----------
-    data_file : DataFrame
-        Pandas DataFrame read from a given .csv/.txt file
+    data_file : DataFrame, Corpus or str
+        Pandas DataFrame read from a given .csv/.txt file, a compiled scenario Corpus or
+        CorpusMix, or the path of a .csv to stream in chunks
 
     labeled : boolean
         boolean value to determine if output should contain labels
         Default : False
     """
-    original_path = 'originaltext.csv'
+    original_path = 'originaltext.csv' + suffix(compression)
     path_creation(original_path)
-    text_column = data_file.columns.get_loc("text")
-    label_column = data_file.columns.get_loc("label")
-    with open(textoutputdir+original_path, 'w') as of:
-        write_header(of)
-        for x in range(len(data_file)):
-            of.write(str(data_file.iloc[x, text_column]))
-            if labeled:
-                of.write(',')
-                of.write(str(data_file.iloc[x, label_column]))
-            of.write('\n')
+    from tools.corpus import iter_chunks
+    metrics = get_metrics()
+    with metrics.timer('write'), open_output(textoutputdir+original_path, 'w', compression, compress_level, buffering=WRITE_BUFFER) as of:
+        if getattr(data_file, 'mixed', False):
+            write_header(of, labeled, scenario=True)
+            for name, corpus in zip(data_file.names, data_file.corpora):
+                for texts, labels in iter_chunks(corpus):
+                    write_rows(of, texts, labels, labeled, [name] * len(texts))
+                    metrics.count('original_rows', len(texts))
+        else:
+            write_header(of, labeled)
+            for texts, labels in iter_chunks(data_file):
+                write_rows(of, texts, labels, labeled)
+                metrics.count('original_rows', len(texts))
     of.close()
 
-def rand_sample_text(data_file, num, labeled, label_case, rand_samp):
+def rand_sample_text(data_file, num, labeled, label_case, rand_samp, seed=None, sampler=None, label_ratio=None):
     """
     Writes an N number of randomly chosen text(s) given by parameter into a .csv file
 
@@ -76,8 +91,9 @@ def rand_sample_text(data_file, num, labeled, label_case, rand_samp):
 
     Parameters:
     -----------
-    data_file : DataFrame
-        Pandas DataFrame read from a given .csv/.txt file
+    data_file : DataFrame or Corpus
+        Pandas DataFrame read from a given .csv/.txt file, a compiled scenario Corpus, or a
+        CorpusMix of several scenarios sampled by their weights
 
     num : int
         N number of augmented text(s) to be outputted
@@ -91,43 +107,41 @@ def rand_sample_text(data_file, num, labeled, label_case, rand_samp):
         String value with boolean-esque properties to either write all negative or positive test cases
         label_case == '0' or label_case == '1'
 
-    augment : boolean
-        Boolean value to determine if text data should be augmented
+    rand_samp : boolean
+        Boolean value to determine if a random sample should be written
         Default : False
 
+    seed : int
+        Seed for the random number generator
+        Default : None
+
+    sampler : BatchSampler
+        A sampler to draw rows from instead of data_file, such as a ReservoirSampler for --stream
+        Default : None
+
+    label_ratio : float
+        Fraction of positive rows in the sample, exact at any num, None samples by label_case
+        Default : None
     """
     if rand_samp:
-        rand_sample_path = 'randsampletext.csv'
+        rand_sample_path = 'randsampletext.csv' + suffix(compression)
         path_creation(rand_sample_path)
 
-        text_column = data_file.columns.get_loc("text")
-        label_column = data_file.columns.get_loc("label")
-
-        pos_case = data_file[data_file.label == 1]
-        neg_case = data_file[data_file.label == 0]
-
-        with open(textoutputdir+rand_sample_path, 'w') as rf:
-            write_header(rf)
-            for _ in range(int(num)):
-                if label_case == '1':
-                    rand_num = rand_state(pos_case)
-                    rf.write(str(pos_case.iloc[rand_num, text_column]))
-                    if labeled:
-                        write_labeled(rf, pos_case, rand_num, label_column)
-                elif label_case == '0':
-                    rand_num = rand_state(neg_case)
-                    rf.write(str(neg_case.iloc[rand_num, text_column]))
-                    if labeled:
-                        write_labeled(rf, neg_case, rand_num, label_column)
-                else:
-                    rand_num = rand_state(data_file)
-                    rf.write(str(data_file.iloc[rand_num, text_column]))
-                    if labeled:
-                        write_labeled(rf, data_file, rand_num, label_column)
-                rf.write('\n')
+        if sampler is None:
+            from tools.sampler import make_sampler
+            sampler = make_sampler(data_file, label_case, seed, label_ratio)
+        metrics = get_metrics()
+        with metrics.timer('sample'):
+            indices, texts, labels = sampler.sample_text(num)
+        scenarios = scenario_column(data_file, indices)
+
+        with metrics.timer('write'), open_output(textoutputdir+rand_sample_path, 'w', compression, compress_level) as rf:
+            write_header(rf, labeled, scenarios is not None)
+            write_rows(rf, texts, labels, labeled, scenarios)
         rf.close()
+        metrics.count('sampled_rows', len(texts))
 
-def augment_data(data_file, num, labeled, label_case, augment):
+def augment_data(data_file, num, labeled, label_case, augment, seed=None, sampler=None, bank=None, label_ratio=None):
     """
     Writes and augments an N number of randomly chosen text(s) given by parameter into a .csv file
 
@@ -135,8 +149,9 @@ def augment_data(data_file, num, labeled, label_case, augment):
 
     Parameters:
     -----------
-    data_file : DataFrame
-        Pandas DataFrame read from a given .csv/.txt file
+    data_file : DataFrame or Corpus
+        Pandas DataFrame read from a given .csv/.txt file, a compiled scenario Corpus, or a
+        CorpusMix of several scenarios sampled by their weights
 
     num : int
         N number of augmented text(s) to be outputted
@@ -153,48 +168,53 @@ def augment_data(data_file, num, labeled, label_case, augment):
     augment : boolean
         Boolean value to determine if text data should be augmented
         Default : False
+
+    seed : int
+        Seed for the random number generator
+        Default : None
+
+    sampler : BatchSampler
+        A sampler to draw rows from instead of data_file, such as a ReservoirSampler for --stream
+        Default : None
+
+    bank : AugmentBank
+        Precomputed variants of data_file's rows to draw from instead of running the augmenter
+        Default : None
+
+    label_ratio : float
+        Fraction of positive rows in the sample, exact at any num, None samples by label_case
+        Default : None
     """
     
     if augment:
-        aug = naf.Sometimes([
-                    naw.SpellingAug(aug_max=1),
-                    naw.ContextualWordEmbsAug(model_path='roberta-base', action='substitute', aug_max=1)
-                    ], aug_p=0.8)
+        engine = get_engine()
 
-        aug_path = 'augmentedtext.csv'
+        aug_path = 'augmentedtext.csv' + suffix(compression)
         path_creation(aug_path)
 
-        text_column = data_file.columns.get_loc("text")
-        label_column = data_file.columns.get_loc("label")
-
-        pos_case = data_file[data_file.label == 1]
-        neg_case = data_file[data_file.label == 0]
-
-        with open(textoutputdir+aug_path, 'w') as af:
-            write_header(af)
-            for _ in range(int(num)):
-                if label_case == '1':
-                    rand_num = rand_state(pos_case)
-                    aug_text = aug.augment(pos_case.iloc[rand_num, text_column])
-                    af.write(str(aug_text))
-                    if labeled:
-                        write_labeled(af, pos_case, rand_num, label_column)
-                elif label_case == '0':
-                    rand_num = rand_state(neg_case)
-                    aug_text = aug.augment(neg_case.iloc[rand_num, text_column])
-                    af.write(str(aug_text))
-                    if labeled:
-                        write_labeled(af, neg_case, rand_num, label_column)
-                else:
-                    rand_num = rand_state(data_file)
-                    aug_text = aug.augment(data_file.iloc[rand_num, text_column])
-                    af.write(str(aug_text))
-                    if labeled:
-                        write_labeled(af, data_file, rand_num, label_column)
-                af.write('\n')
+        if sampler is None:
+            from tools.sampler import make_sampler
+            sampler = make_sampler(data_file, label_case, seed, label_ratio)
+        metrics = get_metrics()
+        with metrics.timer('sample'):
+            indices, texts, labels = sampler.sample_text(num)
+
+        with metrics.timer('augment'):
+            if bank is not None:
+                aug_texts = bank.sample(indices, random.Random(seed))
+            else:
+                # One call so repeated rows are told apart when the engine looks them up in its cache
+                aug_texts = engine.augment(texts, seed)
+        scenarios = scenario_column(data_file, indices)
+        with metrics.timer('write'), open_output(textoutputdir+aug_path, 'w', compression, compress_level) as af:
+            write_header(af, labeled, scenarios is not None)
+            for start in range(0, len(texts), engine.batch_size):
+                write_rows(af, aug_texts[start:start+engine.batch_size], labels[start:start+engine.batch_size], labeled,
+                           None if scenarios is None else scenarios[start:start+engine.batch_size])
         af.close()
+        metrics.count('augmented_rows', len(texts))
 
-def custom_text_write(text, num, augment):
+def custom_text_write(text, num, augment, seed=None):
     """
     Writes custom text defined in command line into a .csv file
 
@@ -206,47 +226,68 @@ def custom_text_write(text, num, augment):
     num : int
         N number of times text will be augmented
         Default : 5
+
+    seed : int
+        Seed of the run, seeded augmentations are memoized in the augmentation cache
+        Default : None
     """
-    custom_path = 'customtext.csv'
+    custom_path = 'customtext.csv' + suffix(compression)
     path_creation(custom_path)
 
-    with open(textoutputdir+custom_path, 'w') as cf:
+    with open_output(textoutputdir+custom_path, 'w', compression, compress_level) as cf:
         for _ in range(int(num)):
             cf.write(text)
             cf.write('\n')
     cf.close()
 
     if augment:
-        aug_path = 'augmentedtext.csv'
+        aug_path = 'augmentedtext.csv' + suffix(compression)
         path_creation(aug_path)
         
-        aug = naf.Sometimes([
-                naw.SpellingAug(aug_max=1),
-                naw.ContextualWordEmbsAug(model_path='roberta-base', action='substitute', aug_max=1)
-                ], aug_p=0.8)
-
-        with open(textoutputdir+aug_path, 'w') as af:
-            for _ in range(int(num)):
-                aug_text = aug.augment(text)
+        with get_metrics().timer('augment'):
+            aug_texts = get_engine().augment([text] * int(num), seed)
+        with open_output(textoutputdir+aug_path, 'w', compression, compress_level) as af:
+            for aug_text in aug_texts:
                 af.write(str(aug_text))
                 af.write('\n')
         af.close()
 
+def scenario_column(data_file, indices):
+    # Rows of a multi-scenario run carry the scenario they were sampled from
+    if getattr(data_file, 'mixed', False):
+        return data_file.scenarios(indices)
+    return None
+
 def scenario_error():
     print('\n', '----------------------------------------------------------------------', '\n')
     print('  UNSUPPORTED SCENARIO WAS CHOSEN |', 'PLEASE CHOOSE A SUPPORTED SCENARIO')
     print('\n', '----------------------------------------------------------------------', '\n')
     print('Available Scenarios:', '\n', '-- secrecy', '\n', '-- ga', '\n', '-- rumor', '\n', '-- cov', '\n')
 
-def write_header(file_name):
-    return file_name.write('text,'), file_name.write('label'), file_name.write('\n')
+def column_names(labeled, scenario=False):
+    # The header and the rows are built from the same list, unlabeled output has no label column
+    return ['text'] + (['label'] if labeled else []) + (['scenario'] if scenario else [])
+
+def write_header(file_name, labeled, scenario=False):
+    return file_name.write(','.join(column_names(labeled, scenario))), file_name.write('\n')
 
-def write_labeled(file_name, data_file, rand_state, label_column):
-    return file_name.write(','), file_name.write(str(data_file.iloc[rand_state, label_column]))
+def write_rows(file_name, texts, labels, labeled, scenarios=None):
+    writer = csv.writer(file_name, lineterminator='\n')
+    values = {'text': texts, 'label': labels, 'scenario': scenarios}
+    return writer.writerows(zip(*[values[name] for name in column_names(labeled, scenarios is not None)]))
 
 def run(args):
     print(args)
     logger.debug('Arguments: %s' % args)
+    metrics = get_metrics()
+
+    global verbose, compression, compress_level
+    verbose = args.verbose
+    compression = args.compress
+    compress_level = args.compress_level
+    if compression:
+        # Fails before anything is generated when the level is invalid or zstandard is missing
+        compressor(compression, compress_level)
 
     scenario = args.scenario
     labeled = args.labeled
@@ -256,57 +297,93 @@ def run(args):
     num = args.numdata
     augment = args.augment
     randsamp = args.randsamp
-
-    if input_file:
-        data_file = pd.read_csv(input_file)
-        original_text(data_file, labeled)
-        rand_sample_text(data_file, num, labeled, label_case, randsamp)
-        augment_data(data_file, num, labeled, label_case, augment)
+    seed = args.seed
+    stream = args.stream
+    skip_original = args.skiporiginal
+    label_ratio = args.labelratio
+    if label_ratio is not None and label_case:
+        raise Exception('--labelratio and --labelcase cannot be combined')
+    use_bank = args.bank and augment
+    if use_bank and stream:
+        raise Exception('--bank draws variants by corpus row and cannot be combined with --stream')
+    get_engine().cache.max_bytes = args.augment_cache_mb << 20
+
+    if input_file or scenario:
+        # pandas and numpy are only needed once a corpus is involved
+        from tools.corpus import SCENARIOS, parse_mix, load_mix, scenario_path, read_corpus
+        from tools.sampler import ReservoirSampler
+        from tools.bank import bank_for
+
+    if input_file and stream:
+        if not skip_original:
+            original_text(input_file, labeled)
+        if randsamp or augment:
+            with metrics.timer('load'):
+                sampler = ReservoirSampler(input_file, num, label_case, seed, label_ratio=label_ratio)
+            rand_sample_text(None, num, labeled, label_case, randsamp, seed, sampler)
+            augment_data(None, num, labeled, label_case, augment, seed, sampler)
+    elif input_file:
+        with metrics.timer('load'):
+            data_file = read_corpus(input_file)
+        if not skip_original:
+            original_text(data_file, labeled)
+        rand_sample_text(data_file, num, labeled, label_case, randsamp, seed, label_ratio=label_ratio)
+        augment_data(data_file, num, labeled, label_case, augment, seed, bank=bank_for(input_file) if use_bank else None, label_ratio=label_ratio)
 
     if scenario and not input_file:
-        if scenario == 'secrecy':
-            data_file = pd.read_csv('data/secrecy_corpus.csv')
-            original_text(data_file, labeled)
-            rand_sample_text(data_file, num, labeled, label_case, randsamp)
-            augment_data(data_file, num, labeled, label_case, augment)
-        elif scenario == 'ga':
-            data_file = pd.read_csv('data/ga_corpus.csv')
-            original_text(data_file, labeled)
-            rand_sample_text(data_file, num, labeled, label_case, randsamp)
-            augment_data(data_file, num, labeled, label_case, augment)
-        elif scenario == 'rumor':
-            data_file = pd.read_csv('data/rumor_corpus.csv')
-            original_text(data_file, labeled)
-            rand_sample_text(data_file, num, labeled, label_case, randsamp)
-            augment_data(data_file, num, labeled, label_case, augment)
-        elif scenario == 'cov':
-            data_file = pd.read_csv('data/cov_corpus.csv')
-            original_text(data_file, labeled)
-            rand_sample_text(data_file, num, labeled, label_case, randsamp)
-            augment_data(data_file, num, labeled, label_case, augment)
+        # --scenario takes one scenario or a weighted mix such as ga:0.6,cov:0.2,rumor:0.1,secrecy:0.1,
+        # each corpus is loaded once and mixed output gets a scenario column
+        names, _ = parse_mix(scenario)
+        if set(names) <= set(SCENARIOS):
+            with metrics.timer('load'):
+                mix = load_mix(scenario)
+                data_file = mix if mix.mixed else mix.corpora[0]
+            if not skip_original:
+                original_text(data_file, labeled)
+            rand_sample_text(data_file, num, labeled, label_case, randsamp, seed, label_ratio=label_ratio)
+            augment_data(data_file, num, labeled, label_case, augment, seed, bank=bank_for(mix if mix.mixed else scenario_path(names[0])) if use_bank else None, label_ratio=label_ratio)
         else:
             scenario_error()
 
     if custom:
-        custom_text_write(custom, num, augment)
+        custom_text_write(custom, num, augment, seed)
+
+    if augment:
+        get_engine().report()
+    if args.metrics:
+        metrics.write(args.metrics, program='generatetextdata', args=vars(args))
 
 if __name__ == '__main__':
     start = timeit.default_timer()
 
     logger.info('Parsing Arguments.')
     parser = argparse.ArgumentParser(description='Generate Smart Test Data')
-    parser.add_argument('--scenario', default='secrecy', help='Scenario of generated test data desired')
+    parser.add_argument('--scenario', default='secrecy', help='Scenario of generated test data desired, or a weighted mix such as ga:0.6,cov:0.2,rumor:0.1,secrecy:0.1')
     parser.add_argument('--numdata', default=5, help='Number of test entires to generate.')
     parser.add_argument('--inputfile', default='', help='Input .csv/.txt file for augmentation')
     parser.add_argument('--custom', default='', help='Custom text for data augmentation')
     parser.add_argument('--labelcase', default='', help='Option to choose values that are either 0 or 1')
+    parser.add_argument('--labelratio', default=None, type=float, help='Exact fraction of positive rows in the sample, e.g. 0.05')
+    parser.add_argument('--seed', default=None, type=int, help='Seed for reproducible sampling')
+    parser.add_argument('--stream', default=False, action='store_true', help='Reservoir-sample --inputfile in chunks instead of loading it whole')
+    parser.add_argument('--compress', default='', choices=('',) + COMPRESSIONS, help='Compress the .csv files on a background thread as they are written')
+    parser.add_argument('--compress_level', default=None, type=int, help='Compression level, 1-9 for gzip (default 6) and 1-22 for zstd (default 3)')
+    parser.add_argument('--skiporiginal', default=False, action='store_true', help='Do not export the original text to originaltext.csv')
+    parser.add_argument('--augment_cache_mb', default=256, type=int, help='Size of the on-disk cache of seeded augmentations, 0 disables it')
+    parser.add_argument('--bank', default=False, action='store_true', help='With -a, draw augmented text from the bank built by python -m tools.bank instead of running the augmenter')
+    parser.add_argument('--metrics', default=metrics_file, help='JSON file receiving per-stage timings and counters at the end of the run, empty to skip it')
+    parser.add_argument('--profile', default='', nargs='?', const='textoutput/profile.pstats', help='Run under cProfile and dump the stats to this file (default textoutput/profile.pstats)')
+    parser.add_argument('-v', '--verbose', default=False, action='store_true', help='Print a line for every file written')
     parser.add_argument('-l', '--labeled', default=False, action='store_true', help='Output labels along with text data')
     parser.add_argument('-a', '--augment', default=False, action='store_true', help='Option to write augmented text data for given scenario or inputfile')
     parser.add_argument('-r', '--randsamp', default=False, action='store_true', help='Option to write a random sample of text data from a given scenario or inputfile')
 
     args = parser.parse_args()
     print('\n')
-    run(args)
+    if args.profile:
+        profile(run, args, args.profile)
+    else:
+        run(args)
     print('\n')
     logger.info('End.')
 
@@ -0,0 +1,297 @@
+# Augment
+# Shared augmentation engine for the email and text generators
+
+import os
+import sys
+import time
+import json
+import random
+import sqlite3
+import hashlib
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger('logger')
+
+MODEL_PATH = 'roberta-base'
+BATCH_SIZE = 256
+CACHE_PATH = 'data/.cache/augment.sqlite'
+CACHE_BYTES = 256 << 20
+# Part of every cache key, entries written under another key layout are never looked up
+KEY_VERSION = 3
+
+class AugmentCache:
+    """
+    SQLite memo of augmented texts that persists between runs
+
+    Entries are keyed by a hash of the source text, the augmenter configuration, the run seed and
+    the position of the text within the run, so repeated texts still get their own augmentations
+    and a cached entry is exactly what the model would produce for that position. Once the
+    stored texts pass max_bytes the least recently used entries are evicted
+
+    Parameters:
+    -----------
+    path : str
+        SQLite database file, created on first use
+        Default : 'data/.cache/augment.sqlite'
+
+    max_bytes : int
+        Size of the stored augmentations that triggers eviction
+        Default : 256MB
+    """
+    def __init__(self, path=CACHE_PATH, max_bytes=CACHE_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._db = None
+        self._pid = None
+
+    def connect(self):
+        # Forked workers open their own connection, sqlite handles must not cross a fork
+        if self._db is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._db = sqlite3.connect(self.path, timeout=60)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS augmentations (key TEXT PRIMARY KEY, value TEXT, size INTEGER, used REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS augmentations_used ON augmentations (used)')
+            self._pid = os.getpid()
+        return self._db
+
+    @staticmethod
+    def key(text, config, seed, position):
+        return hashlib.sha1(json.dumps([KEY_VERSION, text, config, seed, position]).encode('utf-8')).hexdigest()
+
+    def get_many(self, keys):
+        """
+        Returns {key: augmented text} for the keys that are cached and marks them as used
+        """
+        db = self.connect()
+        found = {}
+        unique = list(set(keys))
+        for i in range(0, len(unique), 500):
+            part = unique[i:i+500]
+            found.update(db.execute('SELECT key, value FROM augmentations WHERE key IN (%s)' % ','.join('?' * len(part)), part))
+        with db:
+            db.executemany('UPDATE augmentations SET used = ? WHERE key = ?', [(time.time(), k) for k in found])
+        self.hits += sum(1 for k in keys if k in found)
+        self.misses += sum(1 for k in keys if k not in found)
+        return found
+
+    def put_many(self, items):
+        db = self.connect()
+        now = time.time()
+        with db:
+            db.executemany('INSERT OR REPLACE INTO augmentations VALUES (?, ?, ?, ?)',
+                           [(k, v, len(v.encode('utf-8')), now) for k, v in items])
+        self.evict()
+
+    def evict(self):
+        db = self.connect()
+        total = db.execute('SELECT COALESCE(SUM(size), 0) FROM augmentations').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        stale = []
+        for key, size in db.execute('SELECT key, size FROM augmentations ORDER BY used'):
+            if total <= self.max_bytes:
+                break
+            stale.append((key,))
+            total -= size
+        with db:
+            db.executemany('DELETE FROM augmentations WHERE key = ?', stale)
+        self.evicted += len(stale)
+
+def batch_seed(seed, batch):
+    # Seed of aligned batch number batch within a seeded run, 32 bits so every RNG accepts it
+    return int.from_bytes(hashlib.blake2b(('%s:%s' % (seed, batch)).encode('utf-8'), digest_size=4).digest(), 'big')
+
+@contextmanager
+def seeded(seed):
+    """
+    Seeds the random module, NumPy and, once nlpaug has loaded it, torch, whose sampling picks
+    ContextualWordEmbsAug's substitutes, for one batch of augmentations. Their previous states are
+    restored afterwards, so the caller's later draws are the same whether the model ran or the
+    cache answered
+    """
+    import numpy as np
+
+    torch = sys.modules.get('torch')
+    cuda = torch is not None and torch.cuda.is_available()
+    state, np_state = random.getstate(), np.random.get_state()
+    torch_state = torch.get_rng_state() if torch is not None else None
+    cuda_state = torch.cuda.get_rng_state_all() if cuda else None
+    random.seed(seed)
+    np.random.seed(seed)
+    if torch is not None:
+        # Seeds the CUDA generators as well
+        torch.manual_seed(seed)
+    try:
+        yield
+    finally:
+        random.setstate(state)
+        np.random.set_state(np_state)
+        if torch is not None:
+            torch.set_rng_state(torch_state)
+        if cuda:
+            torch.cuda.set_rng_state_all(cuda_state)
+
+class AugmentEngine:
+    """
+    Wraps the SpellingAug/ContextualWordEmbsAug flow so the model is loaded
+    once per process and texts are augmented in batches
+
+    Parameters:
+    -----------
+    model_path : str
+        Transformer model used for contextual substitution
+        Default : 'roberta-base'
+
+    batch_size : int
+        Number of texts sent through the flow in a single call
+        Default : 256
+
+    cache : AugmentCache
+        Memo checked before running the model on seeded calls, None disables it
+        Default : AugmentCache()
+    """
+    def __init__(self, model_path=MODEL_PATH, batch_size=BATCH_SIZE, cache=None):
+        self.model_path = model_path
+        self.batch_size = int(batch_size)
+        self.cache = AugmentCache() if cache is None else cache
+        self.load_time = 0.0
+        self.batch_times = []
+        self._flow = None
+
+    def config(self):
+        # Identifies the flow built by load() and how seeded runs are batched, part of every cache key
+        return 'SpellingAug(aug_max=1)|ContextualWordEmbsAug(%s,substitute,aug_max=1)|Sometimes(aug_p=0.8)|batch_size=%d' % (
+            self.model_path, self.batch_size)
+
+    def load(self):
+        if self._flow is None:
+            start = time.perf_counter()
+
+            # nlpaug pulls in torch/transformers, so it is only imported once augmentation is requested
+            import nlpaug.augmenter.word as naw
+            import nlpaug.flow as naf
+
+            self._flow = naf.Sometimes([
+                    naw.SpellingAug(aug_max=1),
+                    naw.ContextualWordEmbsAug(model_path=self.model_path, action='substitute', aug_max=1, batch_size=self.batch_size)
+                    ], aug_p=0.8)
+            self.load_time = time.perf_counter() - start
+            logger.info('Augmenter model %s loaded in %.3fs', self.model_path, self.load_time)
+        return self._flow
+
+    def augment(self, texts, seed=None, offset=0, cache=True):
+        """
+        Augments a list of texts, returning a list of the same length and order
+
+        Seeded calls split the run into aligned batches, the text at position offset + i of the
+        run belonging to batch (offset + i) // batch_size, and augment each batch in one pass from
+        its own seed. Callers that split a run at multiples of batch_size therefore get the same
+        augmentations however the run was split. Every text is looked up in the cache first and
+        a batch with any miss is run through the model again as a whole, loading it if needed,
+        so cached and fresh texts agree. Unseeded calls ask for fresh augmentations and skip
+        the cache
+        """
+        texts = [str(t) for t in texts]
+        if seed is None:
+            return self._augment(texts)
+        offset = int(offset)
+        batches = self._aligned(offset, len(texts))
+        if not cache or not self.cache or not self.cache.max_bytes:
+            return self._augment(texts, seed, batches)
+
+        config = self.config()
+        keys = [self.cache.key(text, config, seed, offset + i) for i, text in enumerate(texts)]
+        found = self.cache.get_many(keys)
+
+        stale = [(batch, start, end) for batch, start, end in batches if any(key not in found for key in keys[start:end])]
+        if stale:
+            new = {}
+            for batch, start, end in stale:
+                new.update(zip(keys[start:end], self._augment(texts[start:end], seed, [(batch, 0, end - start)])))
+            self.cache.put_many(new.items())
+            found.update(new)
+        return [found[key] for key in keys]
+
+    def _aligned(self, offset, count):
+        # (batch number, start, end) of the aligned batches covering count texts from run position offset
+        batches = []
+        start = 0
+        while start < count:
+            batch = (offset + start) // self.batch_size
+            end = min(count, (batch + 1) * self.batch_size - offset)
+            batches.append((batch, start, end))
+            start = end
+        return batches
+
+    def _augment(self, texts, seed=None, batches=None):
+        # Seeded calls pass the aligned batches of texts, each run through the flow from its own seed
+        flow = self.load()
+        if batches is None:
+            batches = [(None, i, min(i + self.batch_size, len(texts))) for i in range(0, len(texts), self.batch_size)]
+        results = []
+        for batch, start, end in batches:
+            started = time.perf_counter()
+            if seed is None:
+                augmented = self._flow_augment(flow, texts[start:end])
+            else:
+                with seeded(batch_seed(seed, batch)):
+                    augmented = self._flow_augment(flow, texts[start:end])
+            elapsed = time.perf_counter() - started
+            self.batch_times.append(elapsed)
+            logger.info('Augmented batch of %d texts in %.3fs', end - start, elapsed)
+            results.extend(augmented)
+        return results
+
+    @staticmethod
+    def _flow_augment(flow, data):
+        augmented = flow.augment(data)
+        # Older nlpaug releases return a bare string for a single input
+        if isinstance(augmented, str):
+            augmented = [augmented]
+        return [str(a) for a in augmented]
+
+    def take_stats(self):
+        """
+        Returns and resets the timings and cache counters gathered since the last call, so worker
+        processes can hand them to the parent's engine through merge_stats
+        """
+        stats = {'load_time': self.load_time, 'batch_times': self.batch_times}
+        self.load_time, self.batch_times = 0.0, []
+        if self.cache:
+            stats.update(hits=self.cache.hits, misses=self.cache.misses, evicted=self.cache.evicted)
+            self.cache.hits = self.cache.misses = self.cache.evicted = 0
+        return stats
+
+    def merge_stats(self, stats):
+        self.load_time = max(self.load_time, stats['load_time'])
+        self.batch_times.extend(stats['batch_times'])
+        if self.cache and 'hits' in stats:
+            self.cache.hits += stats['hits']
+            self.cache.misses += stats['misses']
+            self.cache.evicted += stats['evicted']
+
+    def report(self):
+        if self.batch_times:
+            total = sum(self.batch_times)
+            logger.info('Augmenter: model load %.3fs | %d batches | %.3fs total | %.3fs mean | %.3fs max per batch',
+                        self.load_time, len(self.batch_times), total, total / len(self.batch_times), max(self.batch_times))
+        if self.cache and self.cache.hits + self.cache.misses:
+            logger.info('Augment cache %s: %d hits | %d misses | %.1f%% hit rate | %d evicted',
+                        self.cache.path, self.cache.hits, self.cache.misses,
+                        100.0 * self.cache.hits / (self.cache.hits + self.cache.misses), self.cache.evicted)
+
+_engine = None
+
+def get_engine():
+    """
+    Returns the process-wide AugmentEngine, creating it on first use
+    """
+    global _engine
+    if _engine is None:
+        _engine = AugmentEngine()
+    return _engine
@@ -0,0 +1,188 @@
+# Bank
+# Precomputed augmentation variants of a corpus, sampled in place of running the augmenter
+
+import os
+import sys
+import json
+import glob
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+import numpy as np
+
+from tools.corpus import signature, load_corpus, open_cache, scenario_path
+from tools.augment import get_engine
+
+logger = logging.getLogger('logger')
+
+BANK_VERSION = 1
+BANK_DIR = 'data/.cache/banks/'
+VARIANTS = 8
+CHUNK_ROWS = 10000
+
+class AugmentBank:
+    """
+    Augmented variants of every corpus row, stored as a compiled Corpus where row * variants + k
+    holds variant k of the source row and carries the source row's label
+
+    Picking a variant is an offset lookup into the memory-mapped texts, so augmented emails cost
+    as much as plain ones once the bank is built
+
+    Parameters:
+    -----------
+    corpus : Corpus
+        The compiled variants, len(corpus) == rows * variants
+
+    variants : int
+        Number of variants per source row
+    """
+    def __init__(self, corpus, variants):
+        self.corpus = corpus
+        self.variants = int(variants)
+
+    def __len__(self):
+        return len(self.corpus) // self.variants
+
+    def variant(self, row, k):
+        return self.corpus.text(int(row) * self.variants + int(k))
+
+    def sample(self, rows, rng=random):
+        """
+        Returns one randomly chosen variant for each source row in rows
+
+        rng is anything with randrange, the global random module by default so seeded
+        generation chunks draw the same variants for any number of workers
+        """
+        return [self.variant(row, rng.randrange(self.variants)) for row in rows]
+
+class BankMix:
+    """
+    The banks of every scenario in a CorpusMix, sampled with the mix's row numbers
+    """
+    def __init__(self, mix, banks):
+        self.mix = mix
+        self.banks = list(banks)
+
+    def sample(self, rows, rng=random):
+        variants = []
+        for row in rows:
+            k, local = self.mix.locate(row)
+            variants.append(self.banks[k].variant(local, rng.randrange(self.banks[k].variants)))
+        return variants
+
+def bank_path(csv_path, bank_dir=BANK_DIR):
+    # Banks are named like corpus caches, so an edited .csv no longer matches its old bank
+    return os.path.join(bank_dir, signature(csv_path))
+
+def build_bank(csv_path, variants=VARIANTS, seed=None, bank_dir=BANK_DIR, chunksize=CHUNK_ROWS):
+    """
+    Augments every row of a .csv with a "text" and "label" column variants times and compiles
+    the results into bank_dir, returning the bank directory
+
+    Rows are augmented about chunksize at a time through the shared AugmentEngine and written out
+    as they finish, so memory follows the chunk rather than the corpus. Seeded builds split the
+    variants at multiples of the engine's batch size, so every aligned batch is augmented in one
+    pass from its own seed, and bypass the augmentation cache
+    """
+    engine = get_engine()
+    corpus = load_corpus(csv_path)
+    variants = int(variants)
+    if variants < 1:
+        raise Exception('An augmentation bank needs at least 1 variant per row')
+
+    path = bank_path(csv_path, bank_dir)
+    total = len(corpus) * variants
+    offsets = np.zeros(total + 1, dtype=np.int64)
+    # Variants are augmented step at a time, a whole number of augmenter batches
+    step = max(1, -(-chunksize * variants // engine.batch_size)) * engine.batch_size
+
+    os.makedirs(bank_dir, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=bank_dir)
+    with open(os.path.join(tmp, 'text.bin'), 'wb') as bf:
+        position = 0
+        for start in range(0, total, step):
+            end = min(start + step, total)
+            augmented = engine.augment([corpus.text(i // variants) for i in range(start, end)], seed, start, cache=False)
+            encoded = [str(text).encode('utf-8') for text in augmented]
+            block = offsets[start + 1:end + 1]
+            np.cumsum([len(text) for text in encoded], out=block)
+            block += position
+            position = int(block[-1])
+            bf.write(b''.join(encoded))
+            logger.info('Banked %d of %d rows of %s', -(-end // variants), len(corpus), csv_path)
+    bf.close()
+
+    labels = np.repeat(np.asarray(corpus.labels), variants)
+    np.save(os.path.join(tmp, 'offsets.npy'), offsets)
+    np.save(os.path.join(tmp, 'labels.npy'), labels)
+    np.save(os.path.join(tmp, 'positives.npy'), np.flatnonzero(labels == 1))
+    np.save(os.path.join(tmp, 'negatives.npy'), np.flatnonzero(labels == 0))
+    with open(os.path.join(tmp, 'meta.json'), 'w') as mf:
+        json.dump({'version': BANK_VERSION, 'source': csv_path, 'rows': len(corpus), 'variants': variants,
+                   'config': engine.config(), 'seed': seed}, mf)
+    mf.close()
+
+    # A rebuild replaces the previous bank of the same source
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp, path)
+    logger.info('Built augmentation bank %s with %d variants per row', path, variants)
+
+    stem = os.path.splitext(os.path.basename(csv_path))[0]
+    for stale in glob.glob(os.path.join(bank_dir, stem + '-*')):
+        if stale != path:
+            shutil.rmtree(stale, ignore_errors=True)
+    return path
+
+def load_bank(csv_path, bank_dir=BANK_DIR):
+    """
+    Returns the AugmentBank built for csv_path, raising if there is none for its current contents
+    """
+    path = bank_path(csv_path, bank_dir)
+    try:
+        with open(os.path.join(path, 'meta.json')) as mf:
+            meta = json.load(mf)
+    except (OSError, ValueError):
+        meta = {}
+    if meta.get('version') != BANK_VERSION:
+        raise Exception('No augmentation bank for %s, build one with: python -m tools.bank --inputfile=%s' % (csv_path, csv_path))
+    return AugmentBank(open_cache(path), meta['variants'])
+
+def load_mix_bank(mix, bank_dir=BANK_DIR):
+    """
+    Returns the BankMix for a CorpusMix of bundled scenarios, raising if any scenario has no bank
+    """
+    return BankMix(mix, [load_bank(scenario_path(name), bank_dir) for name in mix.names])
+
+def bank_for(source, bank_dir=BANK_DIR):
+    """
+    Returns the bank a -a --bank run samples variants from, source being the .csv path of a
+    single corpus or the CorpusMix of a multi-scenario run
+    """
+    return load_bank(source, bank_dir) if isinstance(source, str) else load_mix_bank(source, bank_dir)
+
+if __name__ == '__main__':
+    LOGGING_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    logging.basicConfig(level=logging.INFO, format=LOGGING_FORMAT)
+    logger.setLevel(logging.INFO)
+
+    # python -m tools.bank [--scenario=cov | --inputfile=file.csv] builds banks for the given corpora, or every bundled scenario
+    parser = argparse.ArgumentParser(description='Precompute augmented variants of a corpus for -a runs')
+    parser.add_argument('--scenario', default='', help='Bundled scenario to bank')
+    parser.add_argument('--inputfile', default='', help='Input .csv file to bank')
+    parser.add_argument('--variants', default=VARIANTS, type=int, help='Augmented variants stored per row')
+    parser.add_argument('--seed', default=None, type=int, help='Seed for reproducible banks')
+    args = parser.parse_args()
+
+    if args.inputfile:
+        sources = [args.inputfile]
+    elif args.scenario:
+        sources = ['data/%s_corpus.csv' % args.scenario]
+    else:
+        sources = sorted(glob.glob('data/*_corpus.csv'))
+    for csv_path in sources:
+        if not os.path.exists(csv_path):
+            sys.exit('No corpus at %s' % csv_path)
+        print('#####    BANKED:', build_bank(csv_path, args.variants, args.seed), '  #####')
+    get_engine().report()
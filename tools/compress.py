@@ -0,0 +1,139 @@
+# Compress
+# Streaming gzip and zstd output, compressed on a background thread while the generator keeps writing
+
+import io
+import queue
+import threading
+
+COMPRESSIONS = ('gzip', 'zstd')
+SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+BLOCK_SIZE = 1 << 20
+QUEUE_BLOCKS = 8
+
+def suffix(compression):
+    return SUFFIXES.get(compression, '')
+
+def compressor(compression, level=None):
+    """
+    Returns a compressobj for 'gzip' or 'zstd' at level, the codec's own default when level is None
+
+    zstd needs the optional zstandard package, which is only imported here
+    """
+    if compression == 'gzip':
+        import zlib
+        # wbits 31 writes a gzip header and trailer, with no file name or mtime so output repeats
+        return zlib.compressobj(-1 if level is None else int(level), zlib.DEFLATED, 31)
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception('zstd compression needs the zstandard package: pip install zstandard')
+        return zstandard.ZstdCompressor(level=3 if level is None else int(level)).compressobj()
+    raise Exception('Unsupported compression: %s, choose one of %s' % (compression, ', '.join(COMPRESSIONS)))
+
+class CompressedWriter(io.RawIOBase):
+    """
+    Binary file that compresses everything written to it into fileobj
+
+    Writes are gathered into blocks of block_size bytes which a background thread compresses and
+    writes out while the caller produces the next block. zlib and zstandard release the GIL while
+    compressing, so compression runs alongside generation rather than after it. A write or close
+    raises the first error the thread ran into
+
+    Parameters:
+    -----------
+    fileobj : file
+        Binary file receiving the compressed stream, closed along with the writer
+
+    compression : str
+        'gzip' or 'zstd'
+
+    level : int
+        Compression level, None for the codec default
+        Default : None
+
+    threaded : bool
+        Compresses on a background thread, False compresses inline, which suits small files
+        written in one go
+        Default : True
+
+    block_size : int
+        Number of bytes handed to the compressor at a time
+        Default : 1048576
+    """
+    def __init__(self, fileobj, compression, level=None, threaded=True, block_size=BLOCK_SIZE):
+        super().__init__()
+        self.fileobj = fileobj
+        self.block_size = block_size
+        self._compressor = compressor(compression, level)
+        self._buffer = bytearray()
+        self._error = None
+        self._queue = None
+        self._thread = None
+        if threaded:
+            self._queue = queue.Queue(QUEUE_BLOCKS)
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self._error is not None:
+            raise self._error
+        self._buffer += data
+        if len(self._buffer) >= self.block_size:
+            self._send(bytes(self._buffer))
+            self._buffer = bytearray()
+        return len(data)
+
+    def _send(self, block):
+        if self._queue is None:
+            self.fileobj.write(self._compressor.compress(block))
+        else:
+            self._queue.put(block)
+
+    def _run(self):
+        while True:
+            block = self._queue.get()
+            if block is None:
+                break
+            if self._error is not None:
+                # Keep draining after a failure so write() never blocks on a full queue
+                continue
+            try:
+                self.fileobj.write(self._compressor.compress(block))
+            except Exception as exc:
+                self._error = exc
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._buffer:
+                self._send(bytes(self._buffer))
+                self._buffer = bytearray()
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+            if self._error is not None:
+                raise self._error
+            self.fileobj.write(self._compressor.flush())
+        finally:
+            self.fileobj.close()
+            super().close()
+
+def open_output(path, mode='w', compression='', level=None, encoding=None, buffering=-1, threaded=True):
+    """
+    Opens path for writing or appending like open(), through a CompressedWriter when compression
+    is set. The caller adds the suffix() of the compression to path
+
+    Appending to a compressed file starts a new gzip member or zstd frame, which gzip, zcat and
+    zstd read back as one continuous stream
+    """
+    if not compression:
+        return open(path, mode, buffering=buffering, encoding=encoding)
+    writer = CompressedWriter(open(path, mode.replace('b', '') + 'b'), compression, level, threaded)
+    if 'b' in mode:
+        return writer
+    return io.TextIOWrapper(writer, encoding=encoding)
@@ -0,0 +1,328 @@
+# Corpus
+# Compiles text/label .csv corpora into memory-mapped binary caches
+
+import os
+import sys
+import json
+import glob
+import shutil
+import logging
+import tempfile
+import numpy as np
+
+logger = logging.getLogger('logger')
+
+CACHE_VERSION = 1
+CACHE_DIR = 'data/.cache/'
+CHUNK_ROWS = 100000
+SCENARIOS = ('secrecy', 'ga', 'rumor', 'cov')
+
+class Corpus:
+    """
+    Text/label corpus held as one UTF-8 text blob, an offsets array and a 1-byte label array
+
+    corpus[i] returns the text of row i, corpus[array] returns an object array of texts and
+    corpus.rows(start, end) the texts of a contiguous range of rows
+
+    Parameters:
+    -----------
+    blob : ndarray
+        uint8 array holding every text back to back
+
+    offsets : ndarray
+        int64 array of len(corpus) + 1 byte offsets into blob
+
+    labels : ndarray
+        int8 array of row labels
+
+    positives, negatives : ndarray
+        Row indices with label 1 and label 0, computed from labels when not given
+
+    path : str
+        Cache directory the arrays were mapped from, used to reopen the corpus in worker processes
+        Default : None
+    """
+    def __init__(self, blob, offsets, labels, positives=None, negatives=None, path=None):
+        self.blob = blob
+        self.offsets = offsets
+        self.labels = labels
+        self.positives = np.flatnonzero(labels == 1) if positives is None else positives
+        self.negatives = np.flatnonzero(labels == 0) if negatives is None else negatives
+        self.path = path
+
+    def __len__(self):
+        return len(self.labels)
+
+    def text(self, i):
+        start, end = self.offsets[int(i):int(i)+2].tolist()
+        return str(memoryview(self.blob)[start:end], 'utf-8')
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self.text(key)
+        # Every distinct row is decoded once, straight from the blob with offsets turned into
+        # Python ints in one go, NumPy scalar indexing per row costs more than the decoding itself
+        rows, order = np.unique(np.asarray(key, dtype=np.int64), return_inverse=True)
+        blob = memoryview(self.blob)
+        texts = to_objects([str(blob[start:end], 'utf-8') for start, end in
+                            zip(self.offsets[rows].tolist(), self.offsets[rows + 1].tolist())])
+        return texts[order.reshape(-1)]
+
+    def rows(self, start, end):
+        """
+        Returns an object array of the texts of rows start to end, decoding their span of the
+        blob at once
+        """
+        offsets = self.offsets[start:end+1].tolist()
+        if len(offsets) < 2:
+            return to_objects([])
+        base = offsets[0]
+        span = bytes(memoryview(self.blob)[base:offsets[-1]])
+        text = span.decode('utf-8')
+        if len(text) == len(span):
+            # Plain ASCII, character and byte offsets agree so the decoded span is cut directly
+            return to_objects([text[a-base:b-base] for a, b in zip(offsets, offsets[1:])])
+        return to_objects([span[a-base:b-base].decode('utf-8') for a, b in zip(offsets, offsets[1:])])
+
+    def __reduce__(self):
+        # Workers remap the cache instead of receiving a pickled copy of the arrays
+        if self.path:
+            return (open_cache, (self.path,))
+        return (Corpus, (self.blob, self.offsets, self.labels, self.positives, self.negatives))
+
+class CorpusMix(Corpus):
+    """
+    Several compiled corpora addressed as one, rows of the first corpus come first, then the
+    second's and so on. Labels and per-label index arrays are concatenated once, texts are
+    decoded from each corpus's own memory map
+
+    Parameters:
+    -----------
+    names : list
+        Scenario name of each corpus, recorded with the rows sampled from it
+
+    corpora : list
+        Compiled Corpus objects
+
+    weights : list
+        Relative share of sampled rows drawn from each corpus
+        Default : None, an equal share
+    """
+    def __init__(self, names, corpora, weights=None):
+        self.names = list(names)
+        self.corpora = list(corpora)
+        self.weights = [1.0] * len(self.corpora) if weights is None else [float(w) for w in weights]
+        self.starts = np.zeros(len(self.corpora) + 1, dtype=np.int64)
+        np.cumsum([len(c) for c in self.corpora], out=self.starts[1:])
+        super().__init__(None, None,
+                         np.concatenate([np.asarray(c.labels) for c in self.corpora]),
+                         np.concatenate([np.asarray(c.positives) + start for c, start in zip(self.corpora, self.starts)]),
+                         np.concatenate([np.asarray(c.negatives) + start for c, start in zip(self.corpora, self.starts)]))
+
+    @property
+    def mixed(self):
+        return len(self.corpora) > 1
+
+    def locate(self, i):
+        """
+        Returns (corpus number, row within that corpus) for row i of the mix
+        """
+        k = int(np.searchsorted(self.starts, i, side='right')) - 1
+        return k, int(i) - int(self.starts[k])
+
+    def text(self, i):
+        k, row = self.locate(i)
+        return self.corpora[k].text(row)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self.text(key)
+        # Each corpus decodes its own rows in one call
+        key = np.asarray(key, dtype=np.int64)
+        owners = np.searchsorted(self.starts, key, side='right') - 1
+        texts = np.empty(len(key), dtype=object)
+        for k in np.unique(owners):
+            rows = owners == k
+            texts[rows] = self.corpora[k][key[rows] - self.starts[k]]
+        return texts
+
+    def rows(self, start, end):
+        return self[np.arange(start, min(end, len(self)))]
+
+    def scenarios(self, indices):
+        return np.array(self.names, dtype=object)[np.searchsorted(self.starts, np.asarray(indices), side='right') - 1]
+
+    def __reduce__(self):
+        return (CorpusMix, (self.names, self.corpora, self.weights))
+
+def to_objects(texts):
+    # Object array of a list of str, filled in place so NumPy never looks inside the strings
+    array = np.empty(len(texts), dtype=object)
+    array[:] = texts
+    return array
+
+def scenario_path(name):
+    return 'data/%s_corpus.csv' % name
+
+def parse_mix(spec):
+    """
+    Parses a --scenario value such as 'ga:0.6,cov:0.2,rumor:0.1,secrecy:0.1' into
+    (names, weights), a scenario given without a weight counts as 1
+    """
+    names, weights = [], []
+    for part in str(spec).split(','):
+        name, _, weight = part.partition(':')
+        names.append(name.strip())
+        weights.append(float(weight) if weight.strip() else 1.0)
+    if len(set(names)) != len(names) or min(weights) < 0 or sum(weights) <= 0:
+        raise ValueError('Invalid scenario mix: %s' % spec)
+    return names, weights
+
+def load_mix(spec, cache_dir=CACHE_DIR):
+    """
+    Returns the CorpusMix for a --scenario value, compiling each bundled corpus once
+    """
+    names, weights = parse_mix(spec)
+    return CorpusMix(names, [load_corpus(scenario_path(name), cache_dir) for name in names], weights)
+
+def signature(csv_path):
+    stat = os.stat(csv_path)
+    return '%s-%s-%s' % (os.path.splitext(os.path.basename(csv_path))[0], stat.st_size, stat.st_mtime_ns)
+
+def open_cache(path):
+    """
+    Memory-maps a compiled corpus from its cache directory
+    """
+    blob_path = os.path.join(path, 'text.bin')
+    blob = np.memmap(blob_path, dtype=np.uint8, mode='r') if os.path.getsize(blob_path) else np.empty(0, dtype=np.uint8)
+    return Corpus(blob,
+                  np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r'),
+                  np.load(os.path.join(path, 'labels.npy'), mmap_mode='r'),
+                  np.load(os.path.join(path, 'positives.npy'), mmap_mode='r'),
+                  np.load(os.path.join(path, 'negatives.npy'), mmap_mode='r'),
+                  path)
+
+def encode_csv(csv_path, write, chunksize=CHUNK_ROWS):
+    """
+    Streams the "text" column of a .csv as UTF-8 through write, chunksize rows at a time, and
+    returns the (offsets, labels) arrays for it. Only one chunk of Python strings is alive at once
+    """
+    import pandas as pd
+
+    offsets = [np.zeros(1, dtype=np.int64)]
+    labels = []
+    position = 0
+    for chunk in pd.read_csv(csv_path, usecols=['text', 'label'], chunksize=chunksize):
+        encoded = [str(text).encode('utf-8') for text in chunk['text']]
+        ends = position + np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)))
+        position = int(ends[-1]) if len(ends) else position
+        write(b''.join(encoded))
+        offsets.append(ends)
+        labels.append(encode_labels(csv_path, chunk['label']))
+    return np.concatenate(offsets), (np.concatenate(labels) if labels else np.empty(0, dtype=np.int8))
+
+def encode_labels(csv_path, column):
+    # A missing or fractional label would silently turn into 0 on the cast to int8
+    import pandas as pd
+
+    values = pd.to_numeric(column, errors='coerce')
+    bad = values.isna() | (values != values.round()) | (values < -128) | (values > 127)
+    if bad.any():
+        row = bad.idxmax()
+        label = 'no label' if pd.isna(column[row]) else 'label %r, labels must be integers' % str(column[row])
+        raise Exception('%s: row %d has %s' % (csv_path, row, label))
+    return values.to_numpy().astype(np.int8)
+
+def read_corpus(csv_path, chunksize=CHUNK_ROWS):
+    """
+    Reads a .csv with a "text" and "label" column into an in-memory Corpus without compiling a
+    cache, as used for --inputfile. Takes about the size of the text plus 9 bytes per row, where
+    a DataFrame holds a Python str object for every row
+    """
+    blob = bytearray()
+    offsets, labels = encode_csv(csv_path, blob.extend, chunksize)
+    return Corpus(np.frombuffer(blob, dtype=np.uint8), offsets, labels)
+
+def compile_corpus(csv_path, cache_dir=CACHE_DIR):
+    """
+    Compiles a .csv with a "text" and "label" column into cache_dir and returns the cache directory
+
+    The directory name carries the source size and mtime, so an edited .csv compiles to a new
+    directory and older builds of the same corpus are removed
+    """
+    path = os.path.join(cache_dir, signature(csv_path))
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=cache_dir)
+    try:
+        with open(os.path.join(tmp, 'text.bin'), 'wb') as bf:
+            offsets, labels = encode_csv(csv_path, bf.write)
+        bf.close()
+    except Exception:
+        # A malformed .csv leaves no half-written build behind
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    np.save(os.path.join(tmp, 'offsets.npy'), offsets)
+    np.save(os.path.join(tmp, 'labels.npy'), labels)
+    np.save(os.path.join(tmp, 'positives.npy'), np.flatnonzero(labels == 1))
+    np.save(os.path.join(tmp, 'negatives.npy'), np.flatnonzero(labels == 0))
+    with open(os.path.join(tmp, 'meta.json'), 'w') as mf:
+        json.dump({'version': CACHE_VERSION, 'source': csv_path, 'rows': len(labels)}, mf)
+    mf.close()
+
+    # Another process may have compiled the same source first, in which case its build is kept
+    try:
+        os.rename(tmp, path)
+        logger.info('Compiled %s into %s', csv_path, path)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    stem = os.path.splitext(os.path.basename(csv_path))[0]
+    for stale in glob.glob(os.path.join(cache_dir, stem + '-*')):
+        if stale != path:
+            shutil.rmtree(stale, ignore_errors=True)
+    return path
+
+def load_corpus(csv_path, cache_dir=CACHE_DIR):
+    """
+    Returns the compiled Corpus for csv_path, compiling it first when the cache is missing or stale
+    """
+    path = os.path.join(cache_dir, signature(csv_path))
+    try:
+        with open(os.path.join(path, 'meta.json')) as mf:
+            version = json.load(mf).get('version')
+    except (OSError, ValueError):
+        # Missing, or renamed into place by another process meanwhile: compile_corpus keeps a
+        # build that got there first, so nothing is removed here
+        version = None
+    if version != CACHE_VERSION:
+        if version is not None:
+            # Only a complete build of an older cache layout is thrown away
+            shutil.rmtree(path, ignore_errors=True)
+        path = compile_corpus(csv_path, cache_dir)
+    return open_cache(path)
+
+def iter_chunks(data_file, chunksize=CHUNK_ROWS):
+    """
+    Yields (texts, labels) arrays of up to chunksize rows from a Corpus, a Pandas DataFrame
+    or the path of a .csv, which is read in chunks rather than loaded whole
+    """
+    if isinstance(data_file, str):
+        import pandas as pd
+        for chunk in pd.read_csv(data_file, usecols=['text', 'label'], chunksize=chunksize):
+            yield chunk['text'].to_numpy(dtype=object), chunk['label'].to_numpy()
+        return
+
+    if isinstance(data_file, Corpus):
+        for start in range(0, len(data_file), chunksize):
+            yield data_file.rows(start, start + chunksize), data_file.labels[start:start+chunksize]
+        return
+
+    texts, labels = data_file['text'].to_numpy(dtype=object), data_file['label'].to_numpy()
+    for start in range(0, len(labels), chunksize):
+        yield texts[start:start+chunksize], labels[start:start+chunksize]
+
+if __name__ == '__main__':
+    # python -m tools.corpus [file.csv ...] compiles the given corpora, or every bundled scenario
+    for csv_path in sys.argv[1:] or sorted(glob.glob('data/*_corpus.csv')):
+        print('#####    COMPILED:', compile_corpus(csv_path), '  #####')
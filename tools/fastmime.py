@@ -0,0 +1,148 @@
+# Fastmime
+# Template-based serializer for the common text + html email, with or without attachments
+
+import io
+import sys
+import random
+import datetime
+import binascii
+from email import policy
+from email.utils import format_datetime
+
+from tools.generateemail import create_message, read_message, attachment_cache, logger
+
+MAX_LINE_LENGTH = 78
+
+def _header(name, value):
+    # Short ASCII headers are laid out directly, anything longer or non-ASCII is folded by the email policy
+    line = f'{name}: {value}' if value else f'{name}:'
+    if not line.isascii() or '\n' in line or '\r' in line:
+        return policy.default.fold(name, value)
+    if len(line) <= MAX_LINE_LENGTH:
+        return line + '\n'
+
+    # Long unquoted ASCII values, such as References, are folded at spaces without going through the policy
+    words = line.split(' ')
+    if '"' in line or max(len(w) for w in words) > MAX_LINE_LENGTH - 1:
+        return policy.default.fold(name, value)
+    lines = [words[0]]
+    for word in words[1:]:
+        if len(lines[-1]) + 1 + len(word) > MAX_LINE_LENGTH:
+            lines.append(' ' + word)
+        else:
+            lines[-1] += ' ' + word
+    return '\n'.join(lines) + '\n'
+
+def _body(text):
+    """
+    Returns (transfer encoding, encoded body) for a text part
+
+    Lines are normalised the same way EmailMessage.set_content does, 7bit is used when every
+    line is ASCII and short enough, quoted-printable otherwise
+    """
+    lines = str(text).encode('utf-8').splitlines()
+    body = b'\n'.join(lines) + b'\n'
+    if max((len(x) for x in lines), default=0) <= MAX_LINE_LENGTH and body.isascii():
+        return '7bit', body.decode('ascii')
+    return 'quoted-printable', binascii.b2a_qp(body, istext=True).decode('ascii')
+
+def _boundary(parts):
+    # Same shape as email.generator boundaries, redrawn in the unlikely case a part contains it
+    while True:
+        boundary = '=' * 15 + '%019d' % random.randrange(sys.maxsize) + '=='
+        if not any(boundary in part for part in parts):
+            return boundary
+
+def _attachments(attachments):
+    """
+    Returns the rendered application/octet-stream parts for a ';' separated attachment string
+
+    Payloads come base64 encoded from the shared attachment cache, and since base64 text never
+    contains a generated boundary the parts are not scanned when choosing one
+    """
+    parts = []
+    for a in str(attachments).split(';') if len(attachments) != 0 else []:
+        try:
+            encoded = attachment_cache().get(str(a))
+        except IOError:
+            logger.error('File not accessible or readable')
+            continue
+        parts.append('Content-Type: application/octet-stream\nContent-Transfer-Encoding: base64\n'
+                     + _header('Content-Disposition', 'attachment; filename="%s"' % a) + '\n' + encoded)
+    return parts
+
+def render_message(sender, subject=None, text=None, html=None, date=None, recipients=[], cc_recipients=[], bcc_recipients=[], language='en', charset='utf-8', attachments=[], message_id=None, in_reply_to=None, references=None, scenario=None):
+    """
+    Serializes a text + html email straight to its MIME string, skipping EmailMessage
+
+    Takes the same arguments as create_message, and produces output that read_message parses
+    to the same headers and content as str(create_message(...)). The result is pure 7-bit
+    ASCII, so writing it as bytes needs no further encoding
+    """
+    if not text or not html:
+        raise Exception("Fast rendering needs both text and html content")
+    if not recipients and not cc_recipients and not bcc_recipients:
+        raise Exception("At least one of recipients, cc_recipients, bcc_recipients needs to be provided")
+
+    headers = [_header('From', str(sender)), _header('Subject', subject if subject else '')]
+    if recipients:
+        headers.append(_header('To', ', '.join([str(x) for x in recipients])))
+    if cc_recipients:
+        headers.append(_header('Cc', ', '.join([str(x) for x in cc_recipients])))
+    if bcc_recipients:
+        headers.append(_header('Bcc', ', '.join([str(x) for x in bcc_recipients])))
+    headers.append(_header('Date', format_datetime((date if date else datetime.datetime.now()).replace(microsecond=0))))
+    if message_id:
+        headers.append(_header('Message-ID', message_id))
+    if in_reply_to:
+        headers.append(_header('In-Reply-To', in_reply_to))
+    if references:
+        headers.append(_header('References', references))
+    if scenario:
+        headers.append(_header('X-Scenario', scenario))
+    headers.append(_header('Language', language))
+    headers.append(_header('Charset', charset))
+
+    text_cte, text_body = _body(text)
+    html_cte, html_body = _body(html)
+    boundary = _boundary((text_body, html_body))
+
+    alternative = (
+        f'Content-Type: multipart/alternative;\n boundary="{boundary}"\n'
+        f'\n--{boundary}\n'
+        f'Content-Type: text/plain; charset="utf-8"\nContent-Transfer-Encoding: {text_cte}\nMIME-Version: 1.0\n'
+        f'\n{text_body}'
+        f'\n--{boundary}\n'
+        f'Content-Type: text/html; charset="utf-8"\nContent-Transfer-Encoding: {html_cte}\nMIME-Version: 1.0\n'
+        f'\n{html_body}'
+        f'\n--{boundary}--\n')
+
+    parts = _attachments(attachments)
+    if not parts:
+        return ''.join(headers) + alternative
+
+    # Same layout as make_mixed: the alternative part first, then one part per attachment
+    outer = _boundary((alternative,))
+    return ''.join(headers) + f'Content-Type: multipart/mixed; boundary="{outer}"\n\n' + ''.join(
+        f'--{outer}\n{part}\n' for part in [alternative] + parts) + f'--{outer}--\n'
+
+
+def _summary(message):
+    parsed = read_message(io.StringIO(message))
+    headers = [(name, str(value)) for name, value in parsed.items() if name.lower() not in ('content-type', 'content-transfer-encoding')]
+    parts = [(part.get_content_type(), part.get_content_charset(), part.get_filename(), part.get_content()) for part in parsed.walk() if not part.is_multipart()]
+    return parsed.get_content_type(), headers, parts
+
+def validate_message(**kwargs):
+    """
+    Renders an email with both serializers and raises if read_message parses them differently
+
+    Boundaries and transfer encodings may differ, the parsed headers, part types and decoded
+    content may not. Returns the fast rendering
+    """
+    date = kwargs.pop('date', None) or datetime.datetime.now().replace(microsecond=0)
+    fast = render_message(date=date, **kwargs)
+    standard = str(create_message(date=date, **kwargs))
+    if _summary(fast) != _summary(standard):
+        raise Exception('Fast MIME rendering does not parse the same as create_message:\n%s\n%s' % (_summary(fast), _summary(standard)))
+    return fast
@@ -1,11 +1,12 @@
 from typing import List, Optional, Union, Any
-from email.message import EmailMessage, Message
-from email.mime.base import MIMEBase
-from email import encoders
+from email.message import EmailMessage, Message, MIMEPart
+from collections import OrderedDict
 from dataclasses import dataclass
 import datetime
 import logging
+import base64
 import sys
+import os
 
 LOG_FILE = 'generatemail.log'
 LOGGING_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
@@ -37,30 +38,67 @@ class StandardReplyGenerator:
         walk(msg)        
         return msg
 
+    def make_reply_chain(self, messages: List[EmailMessage]) -> EmailMessage:
+        chain = ReplyChain(self)
+        for msg in messages:
+            chain.add(msg)
+        return chain.message()
+
+    def _reply_with_history(self, msg, prior_msg, reply_text, reply_html):
+        def walk(component):
+            for part in component.iter_parts():
+                if part.get_content_disposition() != 'attachment':
+                    if part['content-type'].subtype == 'html':
+                        body_content = self._strip_right_tag(self._strip_left_tag(part.get_content(), 'html'), 'body')
+                        part.set_content(f'<html>{body_content}{self._html_reply_header(prior_msg)}<p/>{reply_html}</body></html>', subtype='html')
+                    elif part['content-type'].subtype == 'plain':
+                        part.set_content(f'{part.get_content()}{self._text_reply_header(prior_msg)}\n\n{reply_text}', subtype='plain')
+                    else:
+                        walk(part)
+
+        walk(msg)
+        return msg
+
+    def _own_text(self, msg):
+        return msg.get_body(preferencelist=('plain', 'html')).get_content()
+
+    def _own_html(self, msg):
+        # What make_reply quotes of a message: the inside of its html <body>, or its plain text in <pre>
+        body = msg.get_body()
+        if body['content-type'].subtype == 'plain':
+            return f'<pre>{body.get_content()}</pre>'
+        return self._strip_right_tag(self._strip_left_tag(body.get_content(), 'body'), 'body')
+
+    def _html_reply_header(self, prior_msg):
+        from_hdr = f"<b>From:</b> {prior_msg['from']}<br>"
+        to_hdr = f"<b>To:</b> {prior_msg['to']}<br>"
+        cc_hdr = f"<b>Cc:</b> {prior_msg['cc']}<br>" if prior_msg['cc'] else ""
+        bcc_hdr = f"<b>Cc:</b> {prior_msg['bcc']}<br>" if prior_msg['bcc'] else ""
+        date_hdr = f"<b>Date:</b> {prior_msg['date']}<br>" if prior_msg['date'] else ""
+        subject_hdr = f"<b>Subject:</b> {prior_msg['subject']}<br>"
+        return f"""<p><div><div style="border:none;border-top:solid #E1E1E1 1.0pt;padding:3.0pt 0in 0in 0in"><p class="MsoNormal">{date_hdr}{from_hdr}{to_hdr}{cc_hdr}{bcc_hdr}{subject_hdr}</p></div></div>"""
+
+    def _text_reply_header(self, prior_msg):
+        from_hdr = f"From: {prior_msg['from']}\n"
+        to_hdr = f"To: {prior_msg['to']}\n"
+        cc_hdr = f"Cc: {prior_msg['cc']}\n" if prior_msg['cc'] else ""
+        bcc_hdr = f"Cc: {prior_msg['bcc']}\n" if prior_msg['bcc'] else ""
+        date_hdr = f"Date: {prior_msg['date']}\n" if prior_msg['date'] else ""
+        subject_hdr = f"Subject: {prior_msg['subject']}\n"
+        return f'\n----------------------------------------\n{date_hdr}{from_hdr}{to_hdr}{cc_hdr}{bcc_hdr}{subject_hdr}'
+
     def _make_reply_body(self, body, prior_msg):
         if body['content-type'].subtype == 'html':
             prior_body = prior_msg.get_body()
             prior_subtype = prior_body['content-type'].subtype
-            from_hdr = f"<b>From:</b> {prior_msg['from']}<br>"
-            to_hdr = f"<b>To:</b> {prior_msg['to']}<br>"
-            cc_hdr = f"<b>Cc:</b> {prior_msg['cc']}<br>" if prior_msg['cc'] else ""
-            bcc_hdr = f"<b>Cc:</b> {prior_msg['bcc']}<br>" if prior_msg['bcc'] else ""
-            date_hdr = f"<b>Date:</b> {prior_msg['date']}<br>" if prior_msg['date'] else ""
-            subject_hdr = f"<b>Subject:</b> {prior_msg['subject']}<br>"
-            reply_header = f"""<p><div><div style="border:none;border-top:solid #E1E1E1 1.0pt;padding:3.0pt 0in 0in 0in"><p class="MsoNormal">{date_hdr}{from_hdr}{to_hdr}{cc_hdr}{bcc_hdr}{subject_hdr}</p></div></div>"""
+            reply_header = self._html_reply_header(prior_msg)
             reply_body = f'<pre>{prior_body.get_content()}</pre>' if prior_subtype == 'plain' else self._strip_right_tag(self._strip_left_tag(prior_body.get_content(), 'body'), 'body')
             body_content = self._strip_right_tag(self._strip_left_tag(body.get_content(), 'html'), 'body')
             body.set_content(f'<html>{body_content}{reply_header}<p/>{reply_body}</body></html>', subtype='html')
             return True
         elif body['content-type'].subtype == 'plain':
             prior_body = prior_msg.get_body(preferencelist=('plain', 'html'))
-            from_hdr = f"From: {prior_msg['from']}\n"
-            to_hdr = f"To: {prior_msg['to']}\n"
-            cc_hdr = f"Cc: {prior_msg['cc']}\n" if prior_msg['cc'] else ""
-            bcc_hdr = f"Cc: {prior_msg['bcc']}\n" if prior_msg['bcc'] else ""
-            date_hdr = f"Date: {prior_msg['date']}\n" if prior_msg['date'] else ""
-            subject_hdr = f"Subject: {prior_msg['subject']}\n"
-            reply_header = f'\n----------------------------------------\n{date_hdr}{from_hdr}{to_hdr}{cc_hdr}{bcc_hdr}{subject_hdr}'
+            reply_header = self._text_reply_header(prior_msg)
             reply_body = prior_body.get_content()
             body.set_content(f'{body.get_content()}{reply_header}\n\n{reply_body}', subtype='plain')
             return True
@@ -76,6 +114,49 @@ class StandardReplyGenerator:
         close_offset = text.find(close_tag)
         return text[:close_offset] if close_offset >= 0 else text
 
+class ReplyChain:
+    """
+    Builds the last email of a reply chain one email at a time, giving the same result as
+    calling make_reply down the chain
+
+    make_reply re-reads and re-encodes the whole quoted history at every level, which is
+    quadratic in the chain depth. Here each added email appends its own body and the quote
+    header of the email it replies to onto a list of segments, joined newest first only for
+    the final message, so the work is linear in its size. Only the last two emails are kept
+    """
+    def __init__(self, generator: Optional[StandardReplyGenerator] = None):
+        self._generator = generator if generator else StandardReplyGenerator()
+        self._text = []
+        self._html = []
+        self._prior = None
+        self._last = None
+        self.depth = 0
+
+    def add(self, msg: EmailMessage) -> None:
+        generator = self._generator
+        if self._last is None:
+            self._text.append(generator._own_text(msg))
+            self._html.append(generator._own_html(msg))
+        else:
+            if not msg['subject']:
+                prior_subject = self._last['subject']
+                del msg['subject']
+                msg.add_header('subject', prior_subject if prior_subject.lower().startswith("re:") else f'Re: {self._last["subject"]}' )
+            # The previous email becomes quoted history once something replies to it
+            if self._prior is not None:
+                self._text.append(f'{generator._own_text(self._last)}{generator._text_reply_header(self._prior)}\n\n')
+                self._html.append(f'{generator._own_html(self._last)}{generator._html_reply_header(self._prior)}<p/>')
+        self._prior, self._last = self._last, msg
+        self.depth += 1
+
+    def message(self) -> EmailMessage:
+        """
+        Returns the last added email with the quoted history written into its bodies
+        """
+        if self._prior is None:
+            return self._last
+        return self._generator._reply_with_history(self._last, self._prior, ''.join(reversed(self._text)), ''.join(reversed(self._html)))
+
 def write_message(message: EmailMessage, stream):
     from email import generator
     generator = generator.Generator(stream)
@@ -89,6 +170,59 @@ def read_message(stream) -> EmailMessage:
 def make_reply(msg: EmailMessage, prior_msg: EmailMessage) -> EmailMessage:
     return StandardReplyGenerator().make_reply(msg, prior_msg)
 
+def make_reply_chain(messages: List[EmailMessage]) -> EmailMessage:
+    return StandardReplyGenerator().make_reply_chain(messages)
+
+class AttachmentCache:
+    """
+    LRU cache of base64 encoded attachment payloads keyed by path, size and mtime
+
+    An edited file gets a new key, so stale payloads are never served. The least recently
+    used payloads are evicted once the cache holds more than max_bytes of encoded text
+    """
+    def __init__(self, max_bytes: int = 256 << 20):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._keys = {}
+
+    def get(self, path: str) -> str:
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        encoded = self._entries.get(key)
+        if encoded is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return encoded
+
+        self.misses += 1
+        with open(path, 'rb') as f:
+            encoded = base64.encodebytes(f.read()).decode('ascii')
+
+        if key[0] in self._keys:
+            self._evict(self._keys[key[0]])
+        if len(encoded) <= self.max_bytes:
+            self._entries[key] = encoded
+            self._keys[key[0]] = key
+            self.size += len(encoded)
+            while self.size > self.max_bytes:
+                self._evict(next(iter(self._entries)))
+        return encoded
+
+    def _evict(self, key):
+        encoded = self._entries.pop(key, None)
+        if encoded is not None:
+            self.size -= len(encoded)
+            if self._keys.get(key[0]) == key:
+                del self._keys[key[0]]
+
+_attachment_cache = AttachmentCache()
+
+def attachment_cache() -> AttachmentCache:
+    return _attachment_cache
+
 def create_message(
     sender: Union[Participant, str],
     subject: Optional[str] = None,
@@ -100,7 +234,11 @@ def create_message(
     bcc_recipients: List[Union[Participant, str]] = [],
     attachments: Optional[str] = [],
     language: Optional[str] = 'en',
-    charset: Optional[str] = 'utf-8'
+    charset: Optional[str] = 'utf-8',
+    message_id: Optional[str] = None,
+    in_reply_to: Optional[str] = None,
+    references: Optional[str] = None,
+    scenario: Optional[str] = None
 ):
     if not text and not html:
         raise Exception("At least one of text and html content needs to be provided")
@@ -117,6 +255,14 @@ def create_message(
     if bcc_recipients:
         result['Bcc'] = ', '.join([str(x) for x in bcc_recipients])
     result['Date'] = (date if date else datetime.datetime.now()).strftime('%c %z')
+    if message_id:
+        result['Message-ID'] = message_id
+    if in_reply_to:
+        result['In-Reply-To'] = in_reply_to
+    if references:
+        result['References'] = references
+    if scenario:
+        result['X-Scenario'] = scenario
 
     result.add_header('Language', language)
     result.add_header('Charset', charset)
@@ -132,20 +278,23 @@ def create_message(
         result.set_content(html)
         result.set_type('text/html')
     
-    # NEW ATTACHMENT STUFF
+    # Attachments are read and base64 encoded once per file and reused through the attachment cache
     if len(attachments) != 0:
         sepattachments = str(attachments).split(';')
         for a in sepattachments:
             try:
-                with open(str(a), 'rb') as f:
-                    part = MIMEBase('application', 'octet-stream')
-                    part.set_payload(f.read())
-                    encoders.encode_base64(part)
-                    part.add_header('Content-Disposition', f'attachment; filename= {f.name}')
-                    #result.attach(part)
-                    result.add_attachment(part, filename=f.name)
+                encoded = attachment_cache().get(str(a))
             except IOError:
                 logger.error('File not accessible or readable')
+                continue
+            part = MIMEPart()
+            part['Content-Type'] = 'application/octet-stream'
+            part['Content-Transfer-Encoding'] = 'base64'
+            part.add_header('Content-Disposition', 'attachment', filename=str(a))
+            part.set_payload(encoded)
+            if result.get_content_subtype() != 'mixed':
+                result.make_mixed()
+            result.attach(part)
 
     '''for name, content in attachments.items():
         result.add_attachment(content, filename=name)'''
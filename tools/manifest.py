@@ -0,0 +1,128 @@
+# Manifest
+# Checkpoint log of every written email, so an interrupted run can resume where it stopped
+
+import os
+import json
+import threading
+
+MANIFEST_VERSION = 1
+
+class Manifest:
+    """
+    Appends one JSON line per written email with its name, output directory, Message-ID,
+    sampled row and label. The row is the corpus row, except with --stream where it is the
+    position in the reservoir sample, which keeps no source row numbers. Lines are added by the
+    writer threads once a batch has been written, with one flushed write per batch, so the
+    manifest never lists an email the sink has not received
+
+    The first line holds the settings of the run, which a resumed run is checked against
+
+    Parameters:
+    -----------
+    path : str
+        File the manifest is written to
+
+    settings : dict
+        Settings of the run, recorded in the first line of a new manifest
+
+    resume : bool
+        Appends to the manifest of an interrupted run instead of starting a new one
+        Default : False
+    """
+    def __init__(self, path, settings, resume=False):
+        self.path = path
+        self.settings = settings
+        self.done = set()
+        self._dirs = {}
+        self._lock = threading.Lock()
+        if resume:
+            settings, self.done = read_manifest(path)
+            check_settings(settings, self.settings)
+            self._file = open(path, 'a', encoding='utf-8')
+        else:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self._file = open(path, 'w', encoding='utf-8')
+            self._file.write(json.dumps({'version': MANIFEST_VERSION, 'settings': settings}, default=str) + '\n')
+            self._file.flush()
+
+    def _directory(self, directory):
+        # Directories are stored relative to the working directory, the run is resumed from the same place
+        if directory not in self._dirs:
+            self._dirs[directory] = os.path.relpath(directory)
+        return self._dirs[directory]
+
+    def written(self, directory, name):
+        """
+        Returns whether the interrupted run already wrote name into directory
+        """
+        return (self._directory(directory), name) in self.done
+
+    def record(self, batch, rejected=()):
+        """
+        Appends a line for every (directory, name, text, action, entry) record of a written batch,
+        entry being the (Message-ID, row, label) of the email. Records whose position in the batch
+        is in rejected were refused by the sink and are marked so a resumed run sends them again
+        """
+        lines = []
+        for i, (directory, name, _, _, (message_id, row, label)) in enumerate(batch):
+            entry = {'name': name, 'directory': self._directory(directory), 'message_id': message_id, 'row': row, 'label': label}
+            if i in rejected:
+                entry['rejected'] = True
+            lines.append(json.dumps(entry))
+        if not lines:
+            return
+        with self._lock:
+            self._file.write('\n'.join(lines) + '\n')
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+def read_settings(path):
+    """
+    Returns the settings of the run recorded in a manifest without reading its entries
+    """
+    if not os.path.exists(path):
+        raise Exception('No manifest to resume from at %s' % path)
+    with open(path, 'rb') as mf:
+        return json.loads(mf.readline())['settings']
+
+def read_manifest(path):
+    """
+    Returns the settings of the run recorded in a manifest and the set of (directory, name) it
+    wrote, leaving out rejected emails
+
+    A line cut short by the interruption is dropped from the file, so appended lines start on a
+    line of their own
+    """
+    if not os.path.exists(path):
+        raise Exception('No manifest to resume from at %s' % path)
+    done = set()
+    with open(path, 'rb+') as mf:
+        header = json.loads(mf.readline())
+        if header.get('version') != MANIFEST_VERSION:
+            raise Exception('Manifest %s was written by an incompatible version' % path)
+        complete = mf.tell()
+        for line in mf:
+            if not line.endswith(b'\n'):
+                break
+            complete += len(line)
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if not entry.get('rejected'):
+                done.add((entry['directory'], entry['name']))
+        mf.truncate(complete)
+    mf.close()
+    return header['settings'], done
+
+def check_settings(recorded, settings):
+    """
+    Raises when a resumed run's settings differ from those of the run it continues
+    """
+    settings = json.loads(json.dumps(settings, default=str))
+    changed = sorted(key for key in set(recorded) | set(settings) if recorded.get(key) != settings.get(key))
+    if changed:
+        raise Exception('Cannot resume, settings differ from the interrupted run: %s' % ', '.join(
+            '%s (%r, now %r)' % (key, recorded.get(key), settings.get(key)) for key in changed))
@@ -0,0 +1,79 @@
+# Messageid
+# Collision-free email file names and Message-IDs built from a run token, a worker ID and a counter
+
+import os
+import hashlib
+
+WORKER_BITS = 16
+COUNTER_BITS = 48
+REFERENCES_LIMIT = 10
+
+def run_token(seed=None, space=''):
+    """
+    Returns the 64 bit run token, derived from the seed and the ID space so seeded runs repeat
+    their IDs while each space of a run (custom, rand, reply, thread) gets its own, or drawn from
+    os.urandom so separate unseeded runs never share one
+    """
+    if seed is None:
+        return int.from_bytes(os.urandom(8), 'big')
+    return int.from_bytes(hashlib.blake2b(('%s:%s' % (seed, space)).encode('utf-8'), digest_size=8).digest(), 'big')
+
+def id_domain(sender):
+    # Message-IDs use the sender's domain, falling back to localhost for bare names
+    for token in str(sender).replace('<', ' ').replace('>', ' ').split():
+        if '@' in token:
+            return token.rsplit('@', 1)[1].strip('"') or 'localhost'
+    return 'localhost'
+
+class IdGenerator:
+    """
+    Formats IDs as 32 hex digits: 16 for the run token, 4 for the worker and 12 for the counter
+
+    IDs are unique as long as each (run, worker) pair uses each counter value once, which
+    holds for the position of an email within a run. Nothing is hashed per ID
+
+    Parameters:
+    -----------
+    seed : int
+        Seed of the run, None for a random run token
+        Default : None
+
+    worker : int
+        ID space of this generator, separate processes or hosts writing the same seeded run
+        into one store use different workers
+        Default : 0
+
+    domain : str
+        Right hand side of the Message-ID
+        Default : 'localhost'
+
+    space : str
+        Separates the IDs of the different kinds of output one seeded run generates, each counts from 0
+        Default : ''
+    """
+    def __init__(self, seed=None, worker=0, domain='localhost', space=''):
+        if not 0 <= int(worker) < 1 << WORKER_BITS:
+            raise Exception('Worker ID must be between 0 and %d' % ((1 << WORKER_BITS) - 1))
+        self.prefix = '%016x%04x' % (run_token(seed, space), int(worker))
+        self.domain = domain
+
+    def name(self, counter):
+        if not 0 <= counter < 1 << COUNTER_BITS:
+            raise Exception('ID counter out of range: %s' % counter)
+        return '%s%012x' % (self.prefix, counter)
+
+    def message_id(self, name):
+        return '<%s@%s>' % (name, self.domain)
+
+    def thread_headers(self, position, limit=REFERENCES_LIMIT):
+        """
+        Returns the (In-Reply-To, References) values for the email at position in a thread whose
+        first email is counter 0, or (None, None) for the first email
+
+        References holds the first email and the latest limit - 1 parents rather than the whole
+        ancestry, so headers stay a fixed size however long the thread gets
+        """
+        if position == 0:
+            return None, None
+        parents = [0] + list(range(max(1, position - limit + 1), position))
+        return self.message_id(self.name(position - 1)), ' '.join(self.message_id(self.name(p)) for p in parents)
@@ -0,0 +1,176 @@
+# Metrics
+# Cumulative per-stage timers and counters for a generation run, written out as JSON, and throttled progress logging
+
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger('logger')
+
+PROGRESS_INTERVAL = 5.0
+
+class Metrics:
+    """
+    Per-stage cumulative timers and named counters
+
+    Stages are timed with `with metrics.timer('stage'):` and can be entered from writer threads.
+    Worker processes keep their own Metrics and hand them to the parent through take() and
+    merge(), so stage times are summed across every process and thread of the run and can add
+    up to more than its wall time
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.seconds = {}
+        self.calls = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _owned(self):
+        # A forked worker starts from a copy of the parent's figures, which the parent already holds
+        if self._pid != os.getpid():
+            self.seconds, self.calls, self.counters = {}, {}, {}
+            self._pid = os.getpid()
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._owned()
+                self.seconds[stage] = self.seconds.get(stage, 0.0) + elapsed
+                self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._owned()
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def take(self):
+        """
+        Returns and resets the timers and counters gathered since the last call
+        """
+        with self._lock:
+            self._owned()
+            stats = {'seconds': self.seconds, 'calls': self.calls, 'counters': self.counters}
+            self.seconds, self.calls, self.counters = {}, {}, {}
+        return stats
+
+    def merge(self, stats):
+        with self._lock:
+            for stage, seconds in stats['seconds'].items():
+                self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+                self.calls[stage] = self.calls.get(stage, 0) + stats['calls'][stage]
+            for name, n in stats['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self, **extra):
+        summary = dict(extra)
+        summary['wall_seconds'] = round(time.perf_counter() - self.started, 6)
+        summary['stages'] = {stage: {'seconds': round(self.seconds[stage], 6), 'calls': self.calls[stage]} for stage in sorted(self.seconds)}
+        summary['counters'] = dict(sorted(self.counters.items()))
+        return summary
+
+    def write(self, path, **extra):
+        """
+        Writes the summary as JSON to path and logs the stage times
+        """
+        summary = self.summary(**extra)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as mf:
+            json.dump(summary, mf, indent=2, default=str)
+        mf.close()
+        logger.info('Stages: %s', ' | '.join('%s %.3fs' % (stage, s['seconds']) for stage, s in summary['stages'].items()) or 'none')
+        print('#####    CREATED:', path, '  #####')
+        return summary
+
+def _clock(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+class Progress:
+    """
+    Counts finished items and logs the count, rate and ETA at most once every interval seconds,
+    so progress costs one log line per interval rather than one print per item. Safe to update
+    from several writer threads
+
+    Parameters:
+    -----------
+    total : int
+        Number of items the run will produce, None when unknown
+        Default : None
+
+    label : str
+        What is being counted
+        Default : 'emails'
+
+    interval : float
+        Minimum seconds between two progress lines, 0 only logs the final line
+        Default : 5.0
+    """
+    def __init__(self, total=None, label='emails', interval=PROGRESS_INTERVAL):
+        self.total = total
+        self.label = label
+        self.interval = float(interval)
+        self.done = 0
+        self.start = self.last = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def update(self, n=1):
+        with self._lock:
+            self.done += n
+            now = time.perf_counter()
+            if self.interval and now - self.last >= self.interval:
+                self.last = now
+                self._log(now)
+
+    def close(self):
+        with self._lock:
+            self._log(time.perf_counter())
+
+    def _log(self, now):
+        elapsed = now - self.start
+        rate = self.done / elapsed if elapsed else 0.0
+        if self.total:
+            eta = _clock((self.total - self.done) / rate) if rate else '?'
+            logger.info('Progress: %d/%d %s (%.1f%%) | %.1f %s/sec | %s elapsed | ETA %s', self.done, self.total, self.label,
+                        100.0 * self.done / self.total, rate, self.label, _clock(elapsed), eta)
+        else:
+            logger.info('Progress: %d %s | %.1f %s/sec | %s elapsed', self.done, self.label, rate, self.label, _clock(elapsed))
+
+_metrics = None
+
+def get_metrics():
+    """
+    Returns the process-wide Metrics, creating it on first use
+    """
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
+
+def profile(function, args, path, top=25):
+    """
+    Runs function(args) under cProfile, dumps the stats to path and prints the top entries by
+    cumulative time. Only the calling process is profiled, not pool workers
+    """
+    import cProfile
+    import pstats
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return function(args)
+    finally:
+        profiler.disable()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        profiler.dump_stats(path)
+        pstats.Stats(profiler, stream=sys.stdout).sort_stats('cumulative').print_stats(top)
+        print('#####    CREATED:', path, '  #####')
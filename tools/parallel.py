@@ -0,0 +1,60 @@
+# Parallel
+# Splits generation work into ordered chunks that run inline or across a process pool
+
+import multiprocessing
+from collections import deque
+
+CHUNK_SIZE = 256
+
+def chunk_tasks(items, chunk_size=CHUNK_SIZE):
+    """
+    Splits a list of per-item work into (offset, items) tasks
+
+    offset is the position of the first item within the whole run, so a chunk
+    produces the same output no matter which process builds it
+    """
+    return [(offset, items[offset:offset+chunk_size]) for offset in range(0, len(items), chunk_size)]
+
+def map_chunks(func, tasks, workers, initializer, initargs, window=None):
+    """
+    Yields func(task) for every task, in task order
+
+    At most window tasks are in flight across the pool, so workers stop picking up new chunks
+    while the consumer is blocked instead of queueing finished results without limit
+
+    Parameters:
+    -----------
+    func : function
+        Module-level function run once per task
+
+    tasks : List
+        Tasks created by chunk_tasks
+
+    workers : int
+        Number of worker processes, 1 runs everything in the current process
+        Default : 1
+
+    initializer : function
+        Called once per worker (or once in the current process) with initargs,
+        used to load the corpus a single time per process
+
+    window : int
+        Maximum number of submitted but not yet yielded tasks
+        Default : 2 * workers
+    """
+    workers = int(workers)
+    if workers <= 1 or len(tasks) <= 1:
+        initializer(*initargs)
+        for task in tasks:
+            yield func(task)
+        return
+
+    window = max(1, int(window)) if window else 2 * workers
+    with multiprocessing.Pool(min(workers, len(tasks)), initializer, initargs) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(func, (task,)))
+            if len(pending) >= window:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
@@ -0,0 +1,137 @@
+# Pipeline
+# Writer threads fed through bounded queues, so building emails overlaps with writing them
+
+import queue
+import threading
+
+from tools.metrics import get_metrics
+
+QUEUE_CHUNKS = 4
+WRITERS = 1
+
+class WriterPool:
+    """
+    Writes (directory, name, text, action, entry) records on background threads
+
+    Each thread owns its own sinks and reads from its own bounded queue, so put() blocks once a
+    thread falls QUEUE_CHUNKS batches behind and a slow disk holds the builders back instead of
+    finished emails piling up in memory. Ordered sinks (mbox, tar, appended threads) send every
+    record of a directory to the same thread so their output order is kept, other records are
+    spread across threads by name
+
+    Parameters:
+    -----------
+    open_sink : function
+        Called with an output directory, returns the sink used for it on the calling thread
+
+    writers : int
+        Number of writer threads
+        Default : 1
+
+    ordered : bool
+        Whether records of a directory have to be written in order
+        Default : True
+
+    append : bool
+        Whether records are appended to their name rather than written as new files
+        Default : False
+
+    maxsize : int
+        Batches each writer queue holds before put() blocks
+        Default : 4
+
+    progress : Progress
+        Updated with the number of records of every written batch
+        Default : None
+
+    verbose : bool
+        Prints a line for every record that has an action
+        Default : False
+
+    manifest : Manifest
+        Records the entry of every record once its batch has been written, along with the
+        records a sink refused by returning False, such as messages an SMTP server rejected
+        Default : None
+    """
+    def __init__(self, open_sink, writers=WRITERS, ordered=True, append=False, maxsize=QUEUE_CHUNKS, progress=None, verbose=False, manifest=None):
+        self.open_sink = open_sink
+        self.ordered = ordered
+        self.append = append
+        self.progress = progress
+        self.verbose = verbose
+        self.manifest = manifest
+        self.error = None
+        self._queues = [queue.Queue(maxsize) for _ in range(max(1, int(writers)))]
+        self._threads = [threading.Thread(target=self._run, args=(q,), daemon=True) for q in self._queues]
+        for thread in self._threads:
+            thread.start()
+
+    def _run(self, records_queue):
+        metrics = get_metrics()
+        sinks = {}
+        try:
+            while True:
+                batch = records_queue.get()
+                if batch is None:
+                    break
+                if self.error is not None:
+                    # Keep draining after a failure so the producer never blocks on a full queue
+                    continue
+                try:
+                    rejected = set()
+                    with metrics.timer('write'):
+                        for i, (directory, name, text, action, _) in enumerate(batch):
+                            if directory not in sinks:
+                                sinks[directory] = self.open_sink(directory)
+                            if self.append:
+                                accepted = sinks[directory].append(name, text)
+                            else:
+                                accepted = sinks[directory].write(name, text)
+                            if accepted is False:
+                                rejected.add(i)
+                            if action and self.verbose:
+                                print('#####    %s:' % action, name + '.eml  #####')
+                    # Serialized emails are 7-bit, so their length is the number of bytes written
+                    metrics.count('emails_written', len(batch))
+                    metrics.count('bytes_written', sum(len(record[2]) for record in batch))
+                    if self.manifest is not None:
+                        with metrics.timer('manifest'):
+                            self.manifest.record(batch, rejected)
+                    if self.progress is not None:
+                        self.progress.update(len(batch))
+                except Exception as exc:
+                    self.error = exc
+        finally:
+            for output in sinks.values():
+                try:
+                    output.close()
+                except Exception as exc:
+                    self.error = self.error or exc
+
+    def put(self, records):
+        """
+        Queues a chunk of records, blocking while the writer it is routed to is full
+        """
+        if self.error is not None:
+            raise self.error
+        if len(self._queues) == 1:
+            self._queues[0].put(list(records))
+            return
+        batches = [[] for _ in self._queues]
+        for record in records:
+            key = record[0] if self.ordered else (record[0], record[1])
+            batches[hash(key) % len(batches)].append(record)
+        for records_queue, batch in zip(self._queues, batches):
+            if batch:
+                records_queue.put(batch)
+
+    def close(self):
+        """
+        Waits for every queued record to be written, closes the sinks and raises the first writer error
+        """
+        for records_queue in self._queues:
+            records_queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
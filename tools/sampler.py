@@ -0,0 +1,275 @@
+# Sampler
+# Vectorized, seedable row sampling over a text/label corpus
+
+import logging
+import numpy as np
+
+from tools.corpus import Corpus, CorpusMix
+
+logger = logging.getLogger('logger')
+
+def label_counts(num, label_ratio):
+    """
+    Returns the exact (positives, negatives) split of num rows for a positive fraction label_ratio
+    """
+    label_ratio = float(label_ratio)
+    if not 0 <= label_ratio <= 1:
+        raise ValueError('The label ratio must be between 0 and 1, got %s' % label_ratio)
+    positives = int(round(int(num) * label_ratio))
+    logger.info('Sampling %d positive and %d negative rows', positives, int(num) - positives)
+    return positives, int(num) - positives
+
+class BatchSampler:
+    """
+    Draws every corpus row needed for a run in a single NumPy call
+
+    Parameters:
+    -----------
+    data_file : DataFrame or Corpus
+        Pandas DataFrame with a "text" and "label" column, or a compiled Corpus
+
+    label_case : str
+        '1' or '0' restricts sampling to positive or negative rows, anything else samples every row
+        Default : ''
+
+    seed : int
+        Seed for the random number generator
+        Default : None
+
+    label_ratio : float
+        Fraction of positive rows in every sample, drawn from the per-label index arrays so the
+        proportion is exact at any size, None keeps label_case sampling
+        Default : None
+    """
+    def __init__(self, data_file, label_case='', seed=None, label_ratio=None):
+        self.rng = np.random.default_rng(seed)
+        self.label_ratio = label_ratio
+
+        if isinstance(data_file, Corpus):
+            # Compiled corpora carry their label index lists, texts are decoded only when sampled
+            self.texts = data_file
+            self.labels = data_file.labels
+            positives, negatives = data_file.positives, data_file.negatives
+        else:
+            self.texts = data_file['text'].to_numpy(dtype=object)
+            self.labels = data_file['label'].to_numpy()
+            positives, negatives = np.flatnonzero(self.labels == 1), np.flatnonzero(self.labels == 0)
+        self.positives, self.negatives = positives, negatives
+
+        if label_case == '1':
+            self.rows = positives
+        elif label_case == '0':
+            self.rows = negatives
+        else:
+            self.rows = np.arange(len(self.labels))
+
+    def sample(self, num):
+        """
+        Returns an array of num row indices into the full corpus
+        """
+        if self.label_ratio is not None:
+            return self.stratified(num)
+        return self.rows[self.rng.integers(0, len(self.rows), size=int(num))]
+
+    def stratified(self, num):
+        """
+        Returns num row indices holding exactly round(num * label_ratio) positives, shuffled together
+        """
+        return self.draw(*label_counts(num, self.label_ratio))
+
+    def draw(self, k_pos, k_neg):
+        """
+        Returns k_pos positive and k_neg negative row indices, shuffled together
+        """
+        picks = []
+        for rows, k, label in ((self.positives, k_pos, 1), (self.negatives, k_neg, 0)):
+            if k and not len(rows):
+                raise ValueError('No rows with label %s to sample from' % label)
+            picks.append(rows[self.rng.integers(0, len(rows), size=k)] if k else np.empty(0, dtype=np.int64))
+        return self.rng.permutation(np.concatenate(picks))
+
+    def sample_text(self, num):
+        """
+        Returns (indices, texts, labels) arrays for num sampled rows
+        """
+        indices = self.sample(num)
+        return indices, self.texts[indices], self.labels[indices]
+
+def mix_counts(num, weights):
+    """
+    Splits num rows across weights so the counts sum to exactly num, largest remainders first
+    """
+    quotas = np.asarray(weights, dtype=float) / sum(weights) * int(num)
+    counts = np.floor(quotas).astype(np.int64)
+    counts[np.argsort(counts - quotas, kind='stable')[:int(num) - int(counts.sum())]] += 1
+    return counts
+
+class MixSampler(BatchSampler):
+    """
+    Samples a CorpusMix so every scenario gets exactly its weighted share of the rows
+
+    Each scenario is sampled through its own BatchSampler with the same label_case, and the rows
+    of all scenarios are shuffled together. With label_ratio the positive and negative counts of
+    the whole sample are fixed first and each is split across the scenarios by weight, so the
+    proportion is exact over the sample rather than rounded per scenario. Every sampler shares
+    one random generator so seeded runs repeat
+
+    Parameters:
+    -----------
+    mix : CorpusMix
+        The corpora to sample, with the weight of each
+
+    label_case : str
+        '1' or '0' restricts sampling to positive or negative rows, anything else samples every row
+        Default : ''
+
+    seed : int
+        Seed for the random number generator
+        Default : None
+
+    label_ratio : float
+        Fraction of positive rows in the whole sample
+        Default : None
+    """
+    def __init__(self, mix, label_case='', seed=None, label_ratio=None):
+        super().__init__(mix, label_case, seed, label_ratio)
+        self.parts = [BatchSampler(corpus, label_case, label_ratio=label_ratio) for corpus in mix.corpora]
+        for part in self.parts:
+            part.rng = self.rng
+
+    def sample(self, num):
+        """
+        Returns an array of num row indices into the mix
+        """
+        mix = self.texts
+        if self.label_ratio is not None:
+            splits = list(zip(*[mix_counts(k, mix.weights) for k in label_counts(num, self.label_ratio)]))
+            logger.info('Sampling %s', ' | '.join('%d %s (%d positive)' % (k_pos + k_neg, name, k_pos) for name, (k_pos, k_neg) in zip(mix.names, splits)))
+            picks = [start + part.draw(k_pos, k_neg) for part, start, (k_pos, k_neg) in zip(self.parts, mix.starts, splits) if k_pos + k_neg]
+            return self.rng.permutation(np.concatenate(picks)) if picks else np.empty(0, dtype=np.int64)
+        counts = mix_counts(num, mix.weights)
+        logger.info('Sampling %s', ' | '.join('%d %s' % (k, name) for name, k in zip(mix.names, counts)))
+        picks = [start + part.sample(k) for part, start, k in zip(self.parts, mix.starts, counts) if k]
+        return self.rng.permutation(np.concatenate(picks)) if picks else np.empty(0, dtype=np.int64)
+
+def make_sampler(data_file, label_case='', seed=None, label_ratio=None):
+    """
+    Returns a MixSampler for a mix of several scenarios, a BatchSampler otherwise
+    """
+    if isinstance(data_file, CorpusMix) and data_file.mixed:
+        return MixSampler(data_file, label_case, seed, label_ratio)
+    return BatchSampler(data_file, label_case, seed, label_ratio)
+
+CHUNK_ROWS = 100000
+
+class ReservoirSampler(BatchSampler):
+    """
+    Streams a .csv in chunks and keeps a reservoir of up to size rows per label,
+    so peak memory follows size rather than the size of the file
+
+    Rows are drawn without replacement from the reservoirs, mixed across labels in
+    proportion to how often each label occurs in the whole file, or in exactly the
+    proportions of label_ratio when it is given
+
+    Parameters:
+    -----------
+    path : str
+        Path to a .csv file with a "text" and "label" column
+
+    size : int
+        Number of rows the run will sample (--numdata)
+
+    label_case : str
+        '1' or '0' keeps only positive or negative rows, anything else keeps every label
+        Default : ''
+
+    seed : int
+        Seed for the random number generator
+        Default : None
+
+    chunksize : int
+        Number of .csv rows read per chunk
+        Default : 100000
+
+    label_ratio : float
+        Fraction of positive rows in every sample, replaces the file's own label proportions
+        Default : None
+    """
+    def __init__(self, path, size, label_case='', seed=None, chunksize=CHUNK_ROWS, label_ratio=None):
+        import pandas as pd
+
+        self.size = int(size)
+        self.rng = np.random.default_rng(seed)
+        self.label_ratio = label_ratio
+        self.wanted = None if label_ratio is not None else {'1': 1, '0': 0}.get(label_case)
+        self.counts = {}
+        reservoirs = {}
+
+        for chunk in pd.read_csv(path, usecols=['text', 'label'], chunksize=chunksize):
+            # Texts go through str() as read_corpus does, so an empty cell is 'nan' rather than a float
+            texts = np.array([str(text) for text in chunk['text']], dtype=object)
+            labels = chunk['label'].to_numpy()
+            for label in np.unique(labels):
+                if self.wanted is not None and label != self.wanted:
+                    continue
+                if label not in reservoirs:
+                    reservoirs[label] = np.empty(self.size, dtype=object)
+                self._update(reservoirs[label], label, texts[labels == label])
+
+        # Lay the reservoirs end to end so indices work the same as BatchSampler's
+        self.blocks = {}
+        offset = 0
+        for label in sorted(reservoirs):
+            length = min(self.size, self.counts[label])
+            self.blocks[label] = (offset, length)
+            offset += length
+        self.texts = np.concatenate([reservoirs[label][:self.blocks[label][1]] for label in sorted(reservoirs)]) if reservoirs else np.empty(0, dtype=object)
+        self.labels = np.concatenate([np.full(self.blocks[label][1], label) for label in sorted(reservoirs)]) if reservoirs else np.empty(0)
+        self.rows = np.arange(len(self.texts))
+
+    def _update(self, reservoir, label, items):
+        # Vectorized Algorithm R: the row at position t replaces a random slot with probability size/(t+1)
+        seen = self.counts.get(label, 0)
+        fill = min(max(self.size - seen, 0), len(items))
+        reservoir[seen:seen+fill] = items[:fill]
+
+        rest = items[fill:]
+        if len(rest):
+            positions = np.arange(seen + fill, seen + len(items))
+            slots = self.rng.integers(0, positions + 1)
+            keep = slots < self.size
+            slots, rest = slots[keep][::-1], rest[keep][::-1]
+            # When two rows land on the same slot the later one wins, as it would sequentially
+            _, last = np.unique(slots, return_index=True)
+            reservoir[slots[last]] = rest[last]
+        self.counts[label] = seen + len(items)
+
+    def _take(self, label, k):
+        offset, length = self.blocks[label]
+        if k <= length:
+            return offset + self.rng.permutation(length)[:k]
+        return offset + self.rng.integers(0, length, size=k)
+
+    def sample(self, num):
+        """
+        Returns an array of num row indices into the reservoir texts
+        """
+        num = int(num)
+        if self.label_ratio is not None:
+            picks = []
+            for label, k in zip((1, 0), label_counts(num, self.label_ratio)):
+                if k and label not in self.blocks:
+                    raise ValueError('No rows with label %s in the input file' % label)
+                if k:
+                    picks.append(self._take(label, k))
+            return self.rng.permutation(np.concatenate(picks)) if picks else np.empty(0, dtype=np.int64)
+
+        if self.wanted is not None:
+            if self.wanted not in self.blocks:
+                raise ValueError('No rows with label %s in the input file' % self.wanted)
+            return self._take(self.wanted, num)
+
+        labels = sorted(self.blocks)
+        total = sum(self.counts[label] for label in labels)
+        ks = self.rng.multinomial(num, [self.counts[label] / total for label in labels])
+        return self.rng.permutation(np.concatenate([self._take(label, k) for label, k in zip(labels, ks)]))
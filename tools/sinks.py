@@ -0,0 +1,260 @@
+# Sinks
+# Output containers for generated emails: .eml files, mbox, sharded Maildir and streaming tar, optionally gzip or zstd compressed
+
+import io
+import os
+import re
+import time
+import errno
+import hashlib
+import tarfile
+import tempfile
+
+from tools.compress import open_output, suffix
+
+BLOCK_SIZE = 1 << 20
+SINKS = ('eml', 'mbox', 'maildir', 'tar')
+
+_from_line = re.compile(r'^(>*From )', re.MULTILINE)
+
+def make_dirs(path):
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+def part_name(name, part):
+    # The first file of an appended name keeps the name, later ones are numbered <name>-1, <name>-2...
+    return '%s-%d' % (name, part) if part else name
+
+class Appender:
+    """
+    Keeps one buffered handle open for the name being appended to, instead of reopening the file
+    for every message, and rolls over to a new numbered file once max_bytes have been written
+
+    Parameters:
+    -----------
+    open_part : callable
+        Returns the open file for a part name
+
+    max_bytes : int
+        Size at which a new part is started, 0 never rolls over
+        Default : 0
+    """
+    def __init__(self, open_part, max_bytes=0):
+        self.open_part = open_part
+        self.max_bytes = max_bytes
+        self.name = None
+        self.part = 0
+        self.size = 0
+        self._file = None
+
+    def write(self, name, data):
+        if name != self.name:
+            self.close()
+            self.name, self.part, self.size = name, 0, 0
+            self._file = self.open_part(name)
+        elif self.max_bytes and self.size and self.size + len(data) > self.max_bytes:
+            self._file.close()
+            self.part += 1
+            self.size = 0
+            self._file = self.open_part(part_name(name, self.part))
+        self._file.write(data)
+        self.size += len(data)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.name = None
+
+class EmlSink:
+    """
+    Writes every message to its own <name>.eml file inside directory, appended messages
+    (threads) stream into <name>.eml, rolling over to <name>-1.eml... past max_bytes
+
+    With compression set every file is compressed and gets the .gz or .zst suffix, single
+    messages inline on the writer thread and appended ones on a compression thread
+    """
+    def __init__(self, directory, max_bytes=0, compression='', level=None):
+        self.directory = directory
+        self.compression = compression
+        self.level = level
+        self.suffix = '.eml' + suffix(compression)
+        make_dirs(directory)
+        self._appender = Appender(lambda name: open_output(os.path.join(directory, name + self.suffix), 'a', compression, level, buffering=BLOCK_SIZE), max_bytes)
+
+    def _write(self, name, text, file_mode):
+        with open_output(os.path.join(self.directory, name + self.suffix), file_mode, self.compression, self.level, threaded=False) as f:
+            f.write(text)
+            f.write('\n')
+        f.close()
+
+    def write(self, name, text):
+        self._write(name, text, 'w')
+
+    def append(self, name, text):
+        self._appender.write(name, text + '\n')
+
+    def close(self):
+        self._appender.close()
+
+class MboxSink:
+    """
+    Writes every message into a single mboxrd file, quoting body lines that start with "From "
+
+    With max_bytes set the mbox rolls over to <directory>-1.mbox, <directory>-2.mbox..., with
+    compression set the mbox streams through a compression thread into <directory>.mbox.gz or .zst
+    """
+    def __init__(self, directory, max_bytes=0, compression='', level=None):
+        base = directory.rstrip('/')
+        self.path = base + '.mbox' + suffix(compression)
+        make_dirs(os.path.dirname(self.path))
+        self._from = 'From generator@localhost %s\n' % time.asctime()
+        self._appender = Appender(lambda part: open_output(base + part + '.mbox' + suffix(compression), 'w', compression, level, encoding='utf-8', buffering=BLOCK_SIZE), max_bytes)
+
+    def write(self, name, text):
+        # Every message goes to the same file, whose parts are named <directory>.mbox, <directory>-1.mbox...
+        self._appender.write('', self._from + _from_line.sub(r'>\1', text) + ('\n' if text.endswith('\n') else '\n\n'))
+
+    def append(self, name, text):
+        self.write(name, text)
+
+    def close(self):
+        self._appender.close()
+
+class _MaildirPart:
+    """
+    Appended message file in a Maildir's tmp/, moved into new/ once it is closed
+    """
+    def __init__(self, sink, name):
+        self.sink = sink
+        self.name = name
+        self._file = open_output(sink.path(name, 'tmp'), 'a', sink.compression, sink.level, encoding='utf-8', buffering=BLOCK_SIZE)
+
+    def write(self, text):
+        self._file.write(text)
+
+    def close(self):
+        self._file.close()
+        self.sink._deliver(self.name)
+
+class MaildirSink:
+    """
+    Writes every message into one of 256 Maildirs under directory, <directory>/<xx>/{tmp,new,cur},
+    picked by a hash of the message name so no single directory grows unbounded. Every shard is a
+    Maildir of its own that mail readers open directly
+
+    Messages are written to tmp/ and renamed into new/ once complete, so a reader never picks up
+    a partly written message. With compression set every message file is compressed and gets the
+    .gz or .zst suffix
+    """
+    def __init__(self, directory, max_bytes=0, compression='', level=None):
+        self.directory = directory
+        self.compression = compression
+        self.level = level
+        self.suffix = '.eml' + suffix(compression)
+        make_dirs(directory)
+        self._shards = set()
+        self._appender = Appender(lambda name: _MaildirPart(self, name), max_bytes)
+
+    def path(self, name, sub='new'):
+        shard = hashlib.md5(name.encode('utf-8')).hexdigest()[:2]
+        shard_dir = os.path.join(self.directory, shard)
+        if shard not in self._shards:
+            for maildir_sub in ('tmp', 'new', 'cur'):
+                make_dirs(os.path.join(shard_dir, maildir_sub))
+            self._shards.add(shard)
+        return os.path.join(shard_dir, sub, name + self.suffix)
+
+    def _deliver(self, name):
+        os.rename(self.path(name, 'tmp'), self.path(name))
+
+    def _write(self, name, text, file_mode):
+        with open_output(self.path(name, 'tmp'), file_mode, self.compression, self.level, encoding='utf-8', buffering=BLOCK_SIZE, threaded=False) as f:
+            f.write(text)
+            f.write('\n')
+        f.close()
+        self._deliver(name)
+
+    def write(self, name, text):
+        self._write(name, text, 'w')
+
+    def append(self, name, text):
+        self._appender.write(name, text + '\n')
+
+    def close(self):
+        self._appender.close()
+
+class _TarMember:
+    """
+    Spools an appended tar member to a temporary file, which is added to the archive on close
+    since tar members cannot be extended once written
+    """
+    def __init__(self, sink, name):
+        self.sink = sink
+        self.name = name
+        self._spool = tempfile.SpooledTemporaryFile(max_size=BLOCK_SIZE)
+
+    def write(self, text):
+        self._spool.write(text.encode('utf-8'))
+
+    def close(self):
+        size = self._spool.tell()
+        self._spool.seek(0)
+        self.sink._add(self.name, self._spool, size)
+        self._spool.close()
+
+class TarSink:
+    """
+    Streams every message as a <name>.eml member of a single uncompressed tar archive
+
+    Appended messages (threads) are spooled to disk until a different name is written or
+    the member passes max_bytes, when it rolls over to <name>-1.eml, <name>-2.eml...
+
+    With compression set the whole archive streams through a compression thread into
+    <directory>.tar.gz or .tar.zst
+    """
+    def __init__(self, directory, max_bytes=0, compression='', level=None):
+        self.path = directory.rstrip('/') + '.tar' + suffix(compression)
+        make_dirs(os.path.dirname(self.path))
+        self._file = open_output(self.path, 'wb', compression, level)
+        self._tar = tarfile.open(fileobj=self._file, mode='w|', bufsize=BLOCK_SIZE)
+        self._appender = Appender(lambda name: _TarMember(self, name), max_bytes)
+
+    def _add(self, name, fileobj, size):
+        info = tarfile.TarInfo(name + '.eml')
+        info.size = size
+        info.mtime = int(time.time())
+        self._tar.addfile(info, fileobj)
+
+    def write(self, name, text):
+        self._appender.close()
+        data = (text + '\n').encode('utf-8')
+        self._add(name, io.BytesIO(data), len(data))
+
+    def append(self, name, text):
+        self._appender.write(name, text + '\n')
+
+    def close(self):
+        self._appender.close()
+        self._tar.close()
+        self._file.close()
+
+def open_sink(sink, directory, max_bytes=0, compression='', level=None):
+    """
+    Returns the sink named by sink ('eml', 'mbox', 'maildir' or 'tar') for an output directory
+
+    Appended messages roll over to a new file, or tar member, once it holds max_bytes of
+    uncompressed text, 0 never rolls over. compression ('gzip' or 'zstd') compresses the output
+    at level as it is written
+    """
+    if sink == 'mbox':
+        return MboxSink(directory, max_bytes, compression, level)
+    elif sink == 'maildir':
+        return MaildirSink(directory, max_bytes, compression, level)
+    elif sink == 'tar':
+        return TarSink(directory, max_bytes, compression, level)
+    return EmlSink(directory, max_bytes, compression, level)
@@ -0,0 +1,221 @@
+# Smtp
+# Delivers generated emails straight to an SMTP endpoint over a pool of persistent sessions
+
+import re
+import time
+import queue
+import smtplib
+import logging
+import threading
+from email.utils import getaddresses
+
+logger = logging.getLogger('logger')
+
+SMTP_RETRIES = 3
+SMTP_TIMEOUT = 30
+RETRY_DELAY = 0.1
+
+_eols = re.compile(rb'\r?\n')
+_periods = re.compile(rb'(?m)^\.')
+_bcc = re.compile(r'^Bcc:.*\n(?:[ \t].*\n)*', re.MULTILINE | re.IGNORECASE)
+
+def parse_endpoint(endpoint):
+    host, _, port = str(endpoint).rpartition(':')
+    return (host or 'localhost'), int(port or 25)
+
+def envelope(sender, recipients, cc_recipients, bcc_recipients):
+    """
+    Returns the (MAIL FROM, [RCPT TO...]) addresses for the given header values
+    """
+    mail_from = getaddresses([str(sender)])[0][1]
+    rcpt_to = [addr for _, addr in getaddresses([str(x) for x in list(recipients) + list(cc_recipients) + list(bcc_recipients)]) if addr]
+    return mail_from, rcpt_to
+
+def message_data(text):
+    # Bcc recipients are only in the envelope, the header is dropped from the delivered copy.
+    # Lines are not dot-stuffed yet, smtplib.sendmail stuffs them itself
+    head, sep, body = text.partition('\n\n')
+    data = _eols.sub(b'\r\n', (_bcc.sub('', head + '\n').rstrip('\n') + sep + body).encode('utf-8'))
+    return data if data.endswith(b'\r\n') else data + b'\r\n'
+
+class TransientError(Exception):
+    pass
+
+class SmtpPool:
+    """
+    Pool of persistent SMTP sessions shared by the writer threads
+
+    Each delivery borrows an idle session, opening a new one while fewer than sessions are open,
+    and returns it afterwards so connections are reused across messages. When the server
+    advertises PIPELINING the MAIL, RCPT and DATA commands go out in a single write. Dropped
+    connections and 4xx replies are retried up to retries times, 5xx replies count as rejected
+
+    Parameters:
+    -----------
+    host : str
+        SMTP server host
+
+    port : int
+        SMTP server port
+
+    sessions : int
+        Maximum number of concurrent sessions
+        Default : 1
+
+    retries : int
+        Retries per message after a dropped connection or transient failure
+        Default : 3
+    """
+    def __init__(self, host, port, sessions=1, retries=SMTP_RETRIES, timeout=SMTP_TIMEOUT):
+        self.host = host
+        self.port = int(port)
+        self.sessions = max(1, int(sessions))
+        self.retries = int(retries)
+        self.timeout = timeout
+        self.delivered = 0
+        self.rejected = 0
+        self.retried = 0
+        self.opened = 0
+        self.start = None
+        self.end = None
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.sessions)
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            smtp.ehlo_or_helo_if_needed()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.opened += 1
+        return smtp
+
+    def _release(self, smtp):
+        self._idle.put(smtp)
+        self._slots.release()
+
+    def _discard(self, smtp):
+        try:
+            smtp.close()
+        finally:
+            self._slots.release()
+
+    def _send(self, smtp, mail_from, rcpt_to, data):
+        """
+        Runs one mail transaction, raising TransientError for 4xx replies and returning False when
+        the server rejects the message outright
+        """
+        if not smtp.has_extn('pipelining'):
+            try:
+                smtp.sendmail(mail_from, rcpt_to, data)
+                return True
+            except (smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as exc:
+                code = exc.smtp_code
+            except smtplib.SMTPRecipientsRefused as exc:
+                code = min(c for c, _ in exc.recipients.values())
+            smtp.rset()
+            if 400 <= code < 500:
+                raise TransientError(code)
+            return False
+
+        commands = ['MAIL FROM:<%s>' % mail_from] + ['RCPT TO:<%s>' % r for r in rcpt_to] + ['DATA']
+        smtp.send(''.join(c + '\r\n' for c in commands))
+        replies = [smtp.getreply()[0] for _ in commands]
+        mail_code, rcpt_codes, data_code = replies[0], replies[1:-1], replies[-1]
+
+        if data_code == 354 and mail_code == 250 and any(c in (250, 251) for c in rcpt_codes):
+            smtp.send(_periods.sub(b'..', data) + b'.\r\n')
+            code = smtp.getreply()[0]
+            if code == 250:
+                return True
+        else:
+            if data_code == 354:
+                # DATA was accepted although the transaction failed, end it with an empty message
+                smtp.send(b'.\r\n')
+                smtp.getreply()
+            code = max(c for c in replies if c >= 400)
+        smtp.rset()
+        if 400 <= code < 500:
+            raise TransientError(code)
+        return False
+
+    def deliver(self, mail_from, rcpt_to, data):
+        """
+        Delivers one message, returns whether the server accepted it
+        """
+        with self._lock:
+            if self.start is None:
+                self.start = time.perf_counter()
+        for attempt in range(self.retries + 1):
+            try:
+                smtp = self._acquire()
+            except (smtplib.SMTPException, OSError) as exc:
+                smtp, error = None, exc
+            if smtp is not None:
+                try:
+                    accepted = self._send(smtp, mail_from, rcpt_to, data)
+                except TransientError as exc:
+                    self._release(smtp)
+                    error = exc
+                except (smtplib.SMTPException, OSError) as exc:
+                    self._discard(smtp)
+                    error = exc
+                else:
+                    self._release(smtp)
+                    with self._lock:
+                        if accepted:
+                            self.delivered += 1
+                        else:
+                            self.rejected += 1
+                        self.end = time.perf_counter()
+                    return accepted
+
+            if attempt == self.retries:
+                raise Exception('SMTP delivery to %s:%s failed after %d retries: %r' % (self.host, self.port, self.retries, error))
+            with self._lock:
+                self.retried += 1
+            time.sleep(RETRY_DELAY * 2 ** attempt)
+
+    def close(self):
+        while True:
+            try:
+                smtp = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                smtp.close()
+
+    def report(self):
+        elapsed = (self.end - self.start) if self.start is not None and self.end is not None else 0.0
+        rate = self.delivered / elapsed if elapsed else 0.0
+        logger.info('SMTP %s:%s: %d delivered | %d rejected | %d retries | %d sessions opened | %.3fs | %.1f msgs/sec',
+                    self.host, self.port, self.delivered, self.rejected, self.retried, self.opened, elapsed, rate)
+
+class SmtpSink:
+    """
+    Sink that delivers every message through an SmtpPool to a fixed envelope
+    """
+    def __init__(self, pool, mail_from, rcpt_to):
+        self.pool = pool
+        self.mail_from = mail_from
+        self.rcpt_to = rcpt_to
+
+    def write(self, name, text):
+        # Returns False for a message the server rejected, which the manifest records as not delivered
+        return self.pool.deliver(self.mail_from, self.rcpt_to, message_data(text))
+
+    def append(self, name, text):
+        return self.write(name, text)
+
+    def close(self):
+        pass